@@ -1,4 +1,4 @@
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
 import cv2
 import datetime
 import time
@@ -7,69 +7,132 @@ import queue
 import os
 import pytz
 import copy
-import logging
 from PIL import Image 
 import multiprocessing as mp
-from utils import check_time, ManageFPS, TimeLoop, TimeStartStop
+from utils import check_time, Pacer, Backoff, TimeLoop, TimeStartStop, Wakeup
+from framering import SharedFrameRing
+from sources import open_source
+from libmessage import CODECS, LOSSY_CODECS
 
 
 
-class ImageEncoding:
+def encode_frame(img, codec, quality, scale=1.0, isJPEG=False):
 
-    def __init__(self):
+    # Runs in the workers of EncoderPool. cv2 releases the GIL while encoding, so threads
+    # encode in parallel. With isJPEG, img holds the bytes of a JPEG that is decoded first.
+    # Returns the shape, the encoded bytes and the (start, end) wall clock times of the encoding.
 
-        self.__img = np.array([])
-        self.__newFrameIsAvailable = False
-        self.__webp = 0
-        self.__encoded = False
-        self.__img_encoded_bytes = b''
+    if codec not in CODECS:
+        raise ValueError(f"codec must be one of {tuple(CODECS)}")
 
+    if codec in LOSSY_CODECS and ((not isinstance(quality, int)) or quality<=0):
+        raise ValueError("quality must be a positive integer")
 
-    def start(self, img, newFrameIsAvailable, webp):
+    if not isinstance(img, np.ndarray):
+        raise ValueError("img must be a numpy array")
 
-        if not isinstance(newFrameIsAvailable, bool):
-            raise ValueError("newFrameIsAvailable must be a boolian")
+    t_start = time.time()
 
-        if (not isinstance(webp, int)) or webp<=0:
-            raise ValueError("webp must be a positive integer")
+    if isJPEG:
+        img = cv2.imdecode(img, cv2.IMREAD_COLOR)
 
-        if not isinstance(img, np.ndarray):
-            raise ValueError("img must be a numpy array")
+    if scale != 1.0:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
 
-        self.__img = img
-        self.__newFrameIsAvailable = newFrameIsAvailable
-        self.__webp = webp
+    if codec == "raw":
+        return img.shape, np.ascontiguousarray(img).tobytes(), (t_start, time.time())
+
+    if codec == "jpeg":
+        ext, encode_param = ".jpg", [cv2.IMWRITE_JPEG_QUALITY, quality]
+    elif codec == "webp":
+        # Takes long
+        ext, encode_param = ".webp", [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:
+        # Fastest compression, png is for lossless frames rather than small ones
+        ext, encode_param = ".png", [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+    result, img_encoded = cv2.imencode(ext, img, encode_param)  # imgencode is an one axis uint-8 numpy array
+
+    return img.shape, img_encoded.tobytes(), (t_start, time.time())  # it is b'...'
 
-        self.__t = Thread(target=self.__run, args=())
-        self.__t.start()
-        
-    
-    def stop(self):
-        if not self.__encoded:
-            self.__t.join()
 
-    def get_encoded(self):
-        if not self.__encoded:
-            raise Exception
-        return self.__img_encoded_bytes
 
-    def __run(self):
+class EncoderPool:
 
-        if self.__newFrameIsAvailable:
-            # Takes long
-            encode_param = [cv2.IMWRITE_WEBP_QUALITY, self.__webp]
-            result, img_encoded = cv2.imencode(".webp", self.__img, encode_param)  # imgencode is an one axis uint-8 numpy array
-            # img_encoded = np.array(img_encoded)
-            self.__img_encoded_bytes = img_encoded.tobytes()  # it is b'...'
+    # Long-lived encoder workers fed by a job queue. A finished job signals the wakeup,
+    # so the selector loop picks up the result while it keeps servicing sockets.
 
+    def __init__(self, workers=None, use_processes=False, wakeup=None):
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        if (not isinstance(workers, int)) or workers <= 0:
+            raise ValueError("workers must be a positive integer")
+
+        self.wakeup = wakeup
+
+        if use_processes:
+            self.__executor = ProcessPoolExecutor(max_workers=workers)
         else:
-            self.__img_encoded_bytes = b''
-        self.__encoded = True
+            self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="encoder")
+
+
+    def submit(self, fn, *args):
+
+        future = self.__executor.submit(fn, *args)
+
+        if self.wakeup is not None:
+            future.add_done_callback(lambda _: self.wakeup.signal())
+
+        return future
+
+
+    def close(self):
+        self.__executor.shutdown(wait=True, cancel_futures=True)
+
+
+
+def jpeg_size(data):
+
+    # (width, height) from the SOF segment of a JPEG, None if there is none
+
+    i = 2
+    while i + 9 <= len(data):
+
+        if data[i] != 0xFF:
+            return None
+
+        marker = data[i + 1]
+
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = (data[i + 5] << 8) | data[i + 6]
+            width = (data[i + 7] << 8) | data[i + 8]
+            return width, height
+
+        i += 2 + ((data[i + 2] << 8) | data[i + 3])
+
+    return None
+
 
 
 class CameraGetterCV2MP:
 
-    def __init__(self, ID, cam_address=0, fps=60, grab=False, loggingTime=5):
+    RETRIEVE_MARGIN = 2
+
+    # Connection state, published to the server through shared values
+    STATE_CONNECTING = 0
+    STATE_ONLINE = 1
+    STATE_OFFLINE = 2
+    STATES = ("connecting", "online", "offline")
+
+    def __init__(self, ID, cam_address=0, fps=60, grab=False, loggingTime=5, max_resolution=(1920, 1080), slots=4, wakeup=None,
+                 video_format="RTSP"):
 
         if (not isinstance(fps, (int, float))) and fps <= 0:
             raise ValueError("fps must be a positive integer or float")
@@ -82,83 +145,180 @@ class CameraGetterCV2MP:
         self.fps = fps
         self.ID = ID
         self.loggingTime = loggingTime
+        self.max_resolution = max_resolution
+        self.wakeup = wakeup
+        self.video_format = video_format
+        self.__retrieve_pacer = Pacer()
+
+        # Made here, so a bad format or address fails in the server rather than in the process
+        self.source = open_source(video_format, cam_address)
 
         # Variables
-        self.frame_q = mp.Queue(1)
-        self.cam_fps = mp.Queue(1)
+        # Frames are handed to the server through shared memory instead of a pickling queue
+        self.frame_ring = SharedFrameRing(max_frame_bytes=max_resolution[0]*max_resolution[1]*3, slots=slots)
         self.event = mp.Event()
 
+        # Highest sampling rate of the subscribers, set by the server. Every frame of the stream is
+        # grabbed, but only this many per second (times RETRIEVE_MARGIN) are decoded.
+        self.requested_fps = mp.Value("d", 0.0, lock=False)
+
+        # State, number of failed attempts since it was last online and time of the next attempt
+        self.state = mp.Value("i", self.STATE_CONNECTING, lock=False)
+        self.attempts = mp.Value("i", 0, lock=False)
+        self.retry_at = mp.Value("d", 0.0, lock=False)
+        self.backoff = Backoff()
+
 
     def start(self): 
-        self.t = mp.Process(target=self.run, args=())
+        # Daemonic, so it does not outlive the server
+        self.__parent_pid = os.getpid()
+        self.t = mp.Process(target=self.run, args=(), daemon=True)
         self.t.start()
                             
         
     def run(self):
 
-        connected = False
-        print("INFO: Cam", self.ID, "initilized")
+        # Same loop for every source: grab every frame, retrieve only the ones subscribers sample
 
-        cap = cv2.VideoCapture(self.cam_address)
-        
-        # manageFPSforLog = ManageFPS(fps = 1 / self.loggingTime) 
-        manageFPS = ManageFPS(self.fps)
+        print("INFO: Cam", self.ID, "initilized", f"({self.video_format})")
+
+        source = self.source
+        source.open()
+
+        # Live sources are paced by their own stream, self.fps only caps them
+        pacer = Pacer(source.fps or self.fps)
+        isJPEG = source.encoding == SharedFrameRing.ENCODING_JPEG
         
         timeLoop = TimeLoop()
         
-        while True:
+        while not self.event.is_set():
 
-            # if not(manageFPSforLog.still_wait()):
-                # _, FPS = timeLoop.get_DT_FPS()
-                # print("INFO: Real FPS of Cam", self.ID, ":", str(FPS))       
-            
-            if manageFPS.still_wait():
-                continue
+            # Sleeps instead of spinning until the next frame is due
+            pacer.wait()
+
+            # The server was killed without stopping this process
+            if os.getppid() != self.__parent_pid:
+                break
             
-            if not (cap.isOpened()):
-                if connected:
-                    connected = False
-                    print("INFO: Cam", self.ID, "disconnected")  
-                cap.release()
-                cap = cv2.VideoCapture(self.cam_address)
+            if not (source.isOpened()):
+                self.reconnect(source)
                 continue
 
                 
-            if self.grab: cap.grab()
-                
-            ret, frame = cap.read()
+            if self.grab: source.grab()
+
+            ret = source.grab()
+
+            if ret:
+
+                if self.state.value != self.STATE_ONLINE:
+                    print("INFO: Cam", self.ID, "connected")
+                    self.backoff.reset()
+                    self.setState(self.STATE_ONLINE)
+
+                timeLoop.point()
+
+                if not self.isRetrieveTime():
+                    continue
+
+                ret, frame = source.retrieve()
             
             if not ret:
-                if connected:
-                    connected = False
-                    print("INFO: Cam", self.ID, "disconnected")   
-
-                cap.release()
-                cap = cv2.VideoCapture(self.cam_address)
+                self.reconnect(source)
                 continue
 
-            if not connected:
-                connected = True
-                print("INFO: Cam", self.ID, "connected")
+            _, FPS = timeLoop.get_DT_FPS()
 
-            timeLoop.point()
+            if isJPEG:
 
-            if self.frame_q.empty() and self.cam_fps.empty():
-                self.frame_q.put(frame)
-                _, FPS = timeLoop.get_DT_FPS()
-                self.cam_fps.put(FPS)
+                # JPEGs of an MJPEG camera go to the ring as they are, they are only decoded on
+                # the server if a client asks for another codec or size
 
-            if self.event.is_set():
-                break
+                if frame.nbytes > self.frame_ring.max_frame_bytes:
+                    print("WARNING: JPEG of Cam", self.ID, "is larger than a slot of the ring, skipped")
+                    continue
 
-        cap.release()
-            
-         
-    def getFrame(self):
-        if self.frame_q.full() and self.cam_fps.full():
-            return True, self.frame_q.get(), self.cam_fps.get()
-        else:
-            return False, np.array([]), None
+                image_size = jpeg_size(frame.data)
+                if image_size is None:
+                    continue
+
+                self.frame_ring.write(frame, fps=FPS, encoding=SharedFrameRing.ENCODING_JPEG, image_size=image_size)
+
+            else:
+
+                if frame.nbytes > self.frame_ring.max_frame_bytes:
+                    frame = self.fitFrame(frame)
+
+                self.frame_ring.write(frame, fps=FPS)
+
+            if self.wakeup is not None:
+                self.wakeup.signal()
+
+        source.release()
+
+
+    def reconnect(self, source):
+
+        # Reopens the source after the backoff delay, a stop ends the wait early. Sources keep
+        # what worked the last time (e.g. the cv2 backend), so they come back quickly.
+
+        source.release()
+
+        delay = self.backoff.next()
+        print("INFO: Cam", self.ID, "offline, reconnecting in", round(delay, 1), "s")
+        self.setState(self.STATE_OFFLINE, delay)
+
+        if delay > 0 and self.event.wait(delay):
+            return False
+
+        return source.open()
+
+
+    def setState(self, state, retry_in=0.0):
+
+        self.attempts.value = self.backoff.attempts
+        self.retry_at.value = time.time() + retry_in
+        self.state.value = state
+
+        # The server tells the subscribers
+        if self.wakeup is not None:
+            self.wakeup.signal()
+
+
+    def getState(self):
+        # (state name, failed attempts, seconds until the next attempt)
+        return self.STATES[self.state.value], self.attempts.value, max(0.0, self.retry_at.value - time.time())
+
+
+    def isRetrieveTime(self):
+
+        # Frames are retrieved at a higher rate than requested, so the one a subscriber
+        # samples is never much older than the latest frame of the stream
+
+        requested_fps = self.requested_fps.value * self.RETRIEVE_MARGIN
+
+        if requested_fps <= 0:
+            return False
+
+        self.__retrieve_pacer.setRate(requested_fps)
+
+        if not self.__retrieve_pacer.ready():
+            return False
+
+        self.__retrieve_pacer.tick()
+        return True
+
+
+    def fitFrame(self, frame):
+        # Downscales frames larger than max_resolution so they fit in a slot of the ring
+        h, w = frame.shape[:2]
+        scale = min(self.max_resolution[0] / w, self.max_resolution[1] / h)
+        return cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+
+    def getFrame(self, last_seq=0):
+        # The frame is a view of shared memory, valid while frame_ring.isValid(seq)
+        return self.frame_ring.read(last_seq)
 
     def stop(self):
         self.event.set()
@@ -167,64 +327,356 @@ class CameraGetterCV2MP:
         self.t.kill()
         self.t.close()
 
-        self.frame_q.close()
-        self.cam_fps.close()
+        self.frame_ring.close()
+        self.frame_ring.unlink()
+
+
+
+class SharedCamera:
+
+    # One capture process per camera address, shared by all subscribed connections.
+    # Every subscriber tracks the sequence number of the last frame it saw.
+
+    def __init__(self, ID, cam_address, encoders, wakeup=None, video_format="RTSP"):
+
+        self.ID = ID
+        self.cam_address = cam_address
+        self.video_format = video_format
+        self.encoders = encoders
+        self.subscribers = 0
+
+        self.cam = CameraGetterCV2MP(ID=ID, cam_address=cam_address, wakeup=wakeup, video_format=video_format)
+
+        self.__frame = np.array([])
+        self.__fps = None
+        self.__seq = 0
+        self.__encoded = {}
+        self.__framed = {}
+        self.__jobs = {}
+        self.__rates = {}
+
+
+    def start(self):
+        self.cam.start()
+
 
-        self.frame_q.cancel_join_thread()
-        self.cam_fps.cancel_join_thread()     
+    def getFrame(self, last_seq=0):
+
+        frameIsAvailable, frame, fps, seq = self.cam.getFrame(self.__seq)
+
+        if frameIsAvailable:
+            self.__seq = seq
+            self.__frame = frame
+            self.__fps = fps
+
+        if self.__seq > last_seq:
+            return True, self.__frame, self.__fps, self.__seq
+        else:
+            return False, np.array([]), None, last_seq
+
+
+    def getState(self):
+        return self.cam.getState()
+
+
+    def setRate(self, subscriber, fps):
+
+        # The capture process only decodes as many frames as the fastest subscriber needs,
+        # fps None removes the subscriber
+
+        if fps is None:
+            self.__rates.pop(subscriber, None)
+        else:
+            self.__rates[subscriber] = fps
+
+        self.cam.requested_fps.value = max(self.__rates.values(), default=0.0)
+
+
+    def getEncoded(self, codec, quality, frame_message=None, framing=None, scale=1.0):
+
+        # The latest frame is encoded by the encoder pool once per (codec, quality, scale) and
+        # framed by frame_message(encoded, frame_info), if given, once per framing. The result is
+        # handed to every subscriber. Returns None while the encoding is in progress; the wakeup
+        # of the pool is signalled when it is done. Only the latest encoding per key is kept.
+        #
+        # JPEGs of an MJPEG camera are forwarded as they are to full size jpeg streams.
+
+        encoding, image_size = self.cam.frame_ring.encoding(self.__seq)
+        isPassthrough = encoding == SharedFrameRing.ENCODING_JPEG and codec == "jpeg" and scale == 1.0
+
+        if codec not in LOSSY_CODECS or isPassthrough:
+            quality = None
+
+        key = (codec, quality, scale)
+
+        if key in self.__jobs:
+
+            seq, future = self.__jobs[key]
+            if not future.done():
+                return None
+
+            del self.__jobs[key]
+            shape, encoded, times = future.result()
+
+            # The capture process went around the ring while encoding, so the frame may be torn
+            if self.cam.frame_ring.isValid(seq):
+                self.__encoded[key] = (seq, shape, encoded, times)
+                return self.__frame_encoded(key, framing, frame_message)
+
+            self.getFrame(self.__seq)
+
+        elif key in self.__encoded and self.__encoded[key][0] == self.__seq:
+
+            return self.__frame_encoded(key, framing, frame_message)
+
+        if isPassthrough:
+
+            # Only a copy out of the ring, so it is done right here
+            seq = self.__seq
+            t_start = time.time()
+            encoded = bytes(self.__frame)
+
+            if self.cam.frame_ring.isValid(seq):
+                self.__encoded[key] = (seq, (image_size[1], image_size[0], 3), encoded, (t_start, time.time()))
+                return self.__frame_encoded(key, framing, frame_message)
+
+            self.getFrame(self.__seq)
+            return self.getEncoded(codec, key[1], frame_message, framing, scale)
+
+        isJPEG = encoding == SharedFrameRing.ENCODING_JPEG
+        self.__jobs[key] = (self.__seq, self.encoders.submit(encode_frame, self.__frame, codec, key[1], scale, isJPEG))
+
+        return None
+
+
+    def __frame_encoded(self, key, framing, frame_message):
+
+        seq, shape, encoded, times = self.__encoded[key]
+
+        if frame_message is None:
+            return encoded
+
+        if (key, framing) in self.__framed:
+            framed_seq, framed = self.__framed[(key, framing)]
+            if framed_seq == seq:
+                return framed
+
+        frame_info = {
+            "codec": key[0],
+            "seq": seq,
+            "width": shape[1],
+            "height": shape[0],
+            "channels": shape[2] if len(shape) > 2 else 1,
+            "capture-time": self.cam.frame_ring.timestamp(seq),
+            "encode-start": times[0],
+            "encode-time": times[1]
+        }
+
+        framed = frame_message(encoded, frame_info)
+        self.__framed[(key, framing)] = (seq, framed)
+
+        return framed
+
+
+    def stop(self):
+
+        # Running encodings read the shared memory, they are waited for before it is closed
+        for _, future in self.__jobs.values():
+            future.cancel()
+        wait([future for _, future in self.__jobs.values()])
+
+        # Views of the shared memory must be dropped before it is closed
+        self.__frame = np.array([])
+        self.__encoded = {}
+        self.__framed = {}
+        self.__jobs = {}
+        self.cam.stop()
+
+
+
+class CameraRegistry:
+
+    def __init__(self, encoder_workers=None, encoder_processes=False, media_root=None):
+
+        self.cameras = {}
+        self.__next_ID = 1
+
+        # Directory clients can open video files and images from, None for no local files
+        self.media_root = media_root
+
+        # Signalled by capture processes whenever a new frame is in their ring,
+        # and by the encoder pool whenever an encoding is done
+        self.wakeup = Wakeup()
+        self.encoders = EncoderPool(workers=encoder_workers, use_processes=encoder_processes, wakeup=self.wakeup)
+
+
+    def subscribe(self, cam_address, video_format="RTSP"):
+
+        # An MJPEG camera can be captured both decoded and as passthrough
+        key = (video_format, cam_address)
+
+        if key not in self.cameras:
+
+            camera = SharedCamera(ID=str(self.__next_ID), cam_address=cam_address, encoders=self.encoders,
+                                  wakeup=self.wakeup, video_format=video_format)
+            camera.start()
+
+            self.cameras[key] = camera
+            self.__next_ID += 1
+
+        camera = self.cameras[key]
+        camera.subscribers += 1
+
+        print("INFO: Cam", camera.ID, "has", camera.subscribers, "subscriber(s)")
+
+        return camera
+
+
+    def unsubscribe(self, camera):
+
+        camera.subscribers -= 1
+
+        print("INFO: Cam", camera.ID, "has", camera.subscribers, "subscriber(s)")
+
+        if camera.subscribers <= 0:
+            camera.stop()
+            del self.cameras[(camera.video_format, camera.cam_address)]
+
+
+    def close(self):
+
+        for camera in self.cameras.values():
+            camera.stop()
+
+        self.cameras = {}
+        self.encoders.close()
+        self.wakeup.close()
 
 
 
 class VideoShower:
 
-    def __init__(self):
+    # Decoded frames are handed to the display process through a small shared memory ring per
+    # stream id, so only the newest frame is kept and nothing is pickled. The display process
+    # learns about new rings (a stream's first frame, or a larger frame size) from a queue.
+    #
+    # The display process sleeps until a frame arrives (IDLE_TIMEOUT at most, to keep the
+    # windows responsive) and shows at most display_fps frames per second per window. ESC in a
+    # window stops it and signals the wakeup, if given, so the client can close its connections.
+
+    RING_SLOTS = 3
+    IDLE_TIMEOUT = 0.1
+    ESC = 27
+
+    def __init__(self, display_fps=60, wakeup=None):
+
+        self.display_fps = display_fps
+        self.wakeup = wakeup
+
+        # Rings by stream id, in this process
+        self.__rings = {}
+        self.__announce = mp.Queue()
 
-        # Queue
-        self.__q = mp.Queue(60)
-        self.__stop_signal = mp.Queue(1)
+        self.__frame_event = mp.Event()
+        self.__stop_event = mp.Event()
+        self.__esc_event = mp.Event()
         
 
     def start(self):
-        # Set Thread
-        self.__t = mp.Process(target=self.__show, args=())
+        self.__t = mp.Process(target=self.__show, args=(), daemon=True)
         self.__t.start()
 
     def __show(self):
 
-        while True:
+        pacer = Pacer(self.display_fps)
 
-            if not self.__q.empty():
+        # ID: [ring, seq of the frame shown]
+        rings = {}
 
-                (frame, ID) = self.__q.get()
-                    
-                cv2.namedWindow(ID, cv2.WINDOW_NORMAL)
-                cv2.imshow(ID, frame)
-                cv2.waitKey(1)
-            
-            if cv2.waitKey(1)== 27:
-                self.__stopped = True
+        while not self.__stop_event.is_set():
+
+            # Cleared before the rings are read, so a frame written meanwhile wakes the next wait
+            self.__frame_event.wait(self.IDLE_TIMEOUT)
+            self.__frame_event.clear()
+
+            while not self.__announce.empty():
+
+                ID, name = self.__announce.get()
+
+                try:
+                    ring = SharedFrameRing(name=name)
+                except FileNotFoundError:
+                    # Already replaced by a larger one, which is announced next
+                    continue
+
+                if ID in rings:
+                    rings[ID][0].close()
+                else:
+                    cv2.namedWindow(ID, cv2.WINDOW_NORMAL)
+
+                rings[ID] = [ring, 0]
+
+            # Only the newest frame of every stream is shown
+            for ID, shown in rings.items():
+
+                isNew, frame, _, seq = shown[0].read(shown[1])
+
+                if isNew:
+                    shown[1] = seq
+                    cv2.imshow(ID, frame)
+
+                del frame
 
-            if self.__stop_signal.full():
-                if self.__stop_signal.get():
-                    break
+            # Handles the window events as well
+            if rings and cv2.waitKey(1) & 0xFF == self.ESC:
+                self.__esc_event.set()
+                if self.wakeup is not None:
+                    self.wakeup.signal()
+                break
+
+            pacer.wait()
+
+        for ring, _ in rings.values():
+            ring.close()
 
         cv2.destroyAllWindows()
                     
 
     def newFrame(self, frame, ID):
-        if self.__q.full():
-            logging.warning('Not enough processing resources! Queue is full in Video Shower!')
-            tmp = self.__q.get()
-        self.__q.put((frame, ID))   
+
+        # The frame is copied into shared memory before this returns, so the caller can reuse it
+
+        ring = self.__rings.get(ID)
+
+        if ring is None or frame.nbytes > ring.max_frame_bytes:
+
+            if ring is not None:
+                # The display process keeps its mapping of the old ring until it attaches the new one
+                ring.close()
+                ring.unlink()
+
+            ring = SharedFrameRing(max_frame_bytes=frame.nbytes, slots=self.RING_SLOTS)
+            self.__rings[ID] = ring
+            self.__announce.put((ID, ring.name))
+
+        ring.write(np.ascontiguousarray(frame))
+        self.__frame_event.set()
 
         
     def isStopped(self):
-        return self.__stopped
+        # True once ESC was pressed in a window
+        return self.__esc_event.is_set()
         
     def stop(self):
 
-        if self.__stop_signal.empty():
-            self.__stop_signal.put(True)
+        self.__stop_event.set()
+        self.__frame_event.set()
+
+        if self.__t.is_alive():
             self.__t.join()
-            
 
+        for ring in self.__rings.values():
+            ring.close()
+            ring.unlink()
+
+        self.__rings = {}
@@ -5,6 +5,8 @@ import traceback
 import libclient
 import numpy as np
 from camera import VideoShower
+from utils import Wakeup
+from recorder import Recorder
 
 from datetime import datetime, timezone, timedelta
 
@@ -19,16 +21,37 @@ def main(args):
     port = args.port
 
 
+    # One stream per camera id, a single format or address is used for all of them
+    formats = args.format * len(args.cam_ids) if len(args.format) == 1 else args.format
+    addresses = args.address * len(args.cam_ids) if len(args.address) == 1 else args.address
+
+    if not len(formats) == len(addresses) == len(args.cam_ids):
+        raise ValueError("--format and --address take one value, or one per camera id")
+
+    # Servers without "cameras" read the top level format and address, and send the first camera
     request_description = {
         "action": "SendCamFrames",
-        "format": "RTSP",
-        "address": "http://77.222.181.11:8080/mjpg/video.mjpg",
+        "cameras": [{"id": ID, "format": video_format, "address": address}
+                    for ID, video_format, address in zip(args.cam_ids, formats, addresses)],
+        "format": formats[0],
+        "address": addresses[0],
         "samplingRate": 1,
-        "webp": 25
+        "codec": args.codec,
+        "quality": args.quality,
+        "webp": args.quality,
+        "frame-header": "binary"
     }
 
 
-    video_shower = VideoShower()
+    # Signalled by the decoder workers whenever a frame is decoded, and by the video shower
+    # when ESC is pressed
+    wakeup = Wakeup()
+
+    video_shower = VideoShower(wakeup=wakeup) if args.sink in ("display", "both") else None
+    recorder = Recorder(args.record_dir) if args.sink in ("record", "both") else None
+
+    decoders = libclient.Decoder_Pool(workers=args.decoder_workers, wakeup=wakeup)
+    sel.register(wakeup, selectors.EVENT_READ, data=wakeup)
 
 
     def start_connection(host, port, request_description):
@@ -38,8 +61,10 @@ def main(args):
         sock.setblocking(False)
         sock.connect_ex(addr)
         events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        video_shower.start()
-        message = libclient.Message(sel, sock, addr, request_description, video_shower)
+        if video_shower is not None:
+            video_shower.start()
+        message = libclient.Message(sel, sock, addr, request_description, video_shower, decoders=decoders,
+                                    recorder=recorder, credits=args.credits or None)
     #     message = lib.libclient.Message(sel, sock, addr, request_description, video_shower)       
         sel.register(sock, events, data=message) 
 
@@ -52,13 +77,33 @@ def main(args):
 
             events = sel.select(timeout=1)
 
-            for key, mask in events:
+            if any(key.data is wakeup for key, _ in events):
+                wakeup.drain()
+
+            # ESC in a window closes the connections, which ends the loop
+            if video_shower is not None and video_shower.isStopped():
+                print("Video shower stopped, closing connections")
+                for key in list(sel.get_map().values()):
+                    if key.data is not wakeup:
+                        key.data.close()
+                video_shower.stop()
 
-                message = key.data
+            # Sockets with events, and every socket for its decoded frames, pings and timeouts
+            messages = [key.data for key in sel.get_map().values() if key.data is not wakeup]
+            work = [(key.data, mask) for key, mask in events if key.data is not wakeup]
+            work += [(message, None) for message in messages]
+
+            for message, mask in work:
+
+                if message.sock is None:
+                    continue
 
                 try:
 
-                    message.process_events(mask)
+                    if mask is None:
+                        message.poll()
+                    else:
+                        message.process_events(mask)
 
                 except Exception:
 
@@ -68,17 +113,24 @@ def main(args):
                     )
 
                     message.close()
-                    video_shower.stop()
+                    if video_shower is not None:
+                        video_shower.stop()
 
             # Check for a socket being monitored to continue.
-            if not sel.get_map():
+            if not any(key.data is not wakeup for key in sel.get_map().values()):
                 break
 
     except KeyboardInterrupt:
         print("Caught keyboard interrupt, exiting")
 
     finally:
+        if video_shower is not None:
+            video_shower.stop()
+        if recorder is not None:
+            recorder.close()
+        decoders.close()
         sel.close()
+        wakeup.close()
 
 
 
@@ -98,8 +150,67 @@ if __name__ == "__main__":
         '--cam_ids',
         nargs='+',
         type=int,
-        default=[1, 2],
-        help='camera IDs'
+        default=[1],
+        help='stream ids of the cameras, frames are shown in a window per id'
+    )
+
+    parser.add_argument(
+        "--format",
+        nargs='+',
+        type=str,
+        default=["RTSP"],
+        help="source of the frames per camera: RTSP, MJPEG, FILE, IMAGES or SYNTHETIC",
+    )
+
+    parser.add_argument(
+        "--address",
+        nargs='+',
+        type=str,
+        default=["http://77.222.181.11:8080/mjpg/video.mjpg"],
+        help="per camera: camera URL, video file (path[@fps]) or image directory (path[@fps]) under the --media_root of the server, or synthetic size (WIDTHxHEIGHT[@fps])",
+    )
+
+    parser.add_argument(
+        "--codec",
+        type=str,
+        default="webp",
+        help="one of jpeg, webp, png or raw",
+    )
+
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=25,
+        help="quality of jpeg and webp frames, between 1 and 100",
+    )
+
+    parser.add_argument(
+        "--sink",
+        type=str,
+        default="display",
+        choices=["display", "record", "both"],
+        help="show the frames, record them as received, or both",
+    )
+
+    parser.add_argument(
+        "--record_dir",
+        type=str,
+        default="recordings",
+        help="directory of the recording, read it back with recorder.py",
+    )
+
+    parser.add_argument(
+        "--decoder_workers",
+        type=int,
+        default=None,
+        help="number of decoder threads, by default the number of CPUs",
+    )
+
+    parser.add_argument(
+        "--credits",
+        type=int,
+        default=2,
+        help="frames per camera the server may send ahead of the ones shown or recorded, 0 for no limit",
     )
 
     args = parser.parse_args()
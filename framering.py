@@ -0,0 +1,194 @@
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+
+
+class SharedFrameRing:
+
+    # A ring of preallocated frame slots in shared memory. The writer (capture process) fills
+    # the slot after the latest one and then publishes its sequence number; readers get the
+    # latest frame as a numpy view of the slot, without any pickling or copying.
+    #
+    # Frame seq (starting from 1) is always stored in slot (seq - 1) % slots, so a view stays
+    # valid until the writer comes back to that slot, which can be checked with isValid(seq).
+
+    # A slot holds either a decoded frame (ENCODING_RAW) or the bytes of an encoded image,
+    # e.g. a JPEG forwarded as it is from an MJPEG camera, with its image width and height.
+    ENCODING_RAW = 0
+    ENCODING_JPEG = 1
+
+    # header:       slots, max_frame_bytes, latest_seq
+    # slot ints:    seq, height, width, channels, nbytes, encoding, image width, image height
+    # slot floats:  timestamp, fps, (reserved), (reserved)
+    HEADER_LEN = 4
+    SLOT_INTS = 8
+    SLOT_FLOATS = 4
+    ALIGN = 64
+
+
+    def __init__(self, max_frame_bytes=1920*1080*3, slots=4, name=None):
+
+        if name is None:
+
+            if (not isinstance(max_frame_bytes, int)) or max_frame_bytes <= 0:
+                raise ValueError("max_frame_bytes must be a positive integer")
+
+            if (not isinstance(slots, int)) or slots < 2:
+                raise ValueError("slots must be an integer larger than 1")
+
+            max_frame_bytes = self.__aligned(max_frame_bytes)
+            size = self.__data_offset(slots) + slots * max_frame_bytes
+
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.__map(slots, max_frame_bytes)
+
+            self.header[:] = 0
+            self.header[0] = slots
+            self.header[1] = max_frame_bytes
+            self.slot_ints[:] = 0
+            self.slot_floats[:] = 0
+
+        else:
+
+            # Attach to a ring created by another process, which stays its owner
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError:
+                # Before Python 3.13 attaching registers the memory with the resource tracker of
+                # this process, which would unlink it when this process exits
+                self.shm = shared_memory.SharedMemory(name=name)
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+            header = np.ndarray((self.HEADER_LEN,), dtype=np.int64, buffer=self.shm.buf)
+            slots, max_frame_bytes = int(header[0]), int(header[1])
+            del header
+            self.__map(slots, max_frame_bytes)
+
+        self.name = self.shm.name
+        self.slots = slots
+        self.max_frame_bytes = max_frame_bytes
+
+
+    def __aligned(self, n):
+        return (n + self.ALIGN - 1) // self.ALIGN * self.ALIGN
+
+
+    def __data_offset(self, slots):
+        return self.__aligned(8 * (self.HEADER_LEN + slots * (self.SLOT_INTS + self.SLOT_FLOATS)))
+
+
+    def __map(self, slots, max_frame_bytes):
+
+        buf = self.shm.buf
+        offset = 0
+
+        self.header = np.ndarray((self.HEADER_LEN,), dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8 * self.HEADER_LEN
+
+        self.slot_ints = np.ndarray((slots, self.SLOT_INTS), dtype=np.int64, buffer=buf, offset=offset)
+        offset += 8 * slots * self.SLOT_INTS
+
+        self.slot_floats = np.ndarray((slots, self.SLOT_FLOATS), dtype=np.float64, buffer=buf, offset=offset)
+
+        self.data = np.ndarray((slots, max_frame_bytes), dtype=np.uint8, buffer=buf, offset=self.__data_offset(slots))
+
+
+    def write(self, frame, fps=0.0, timestamp=None, encoding=ENCODING_RAW, image_size=None):
+
+        if not isinstance(frame, np.ndarray) or frame.dtype != np.uint8:
+            raise ValueError("frame must be a uint8 numpy array")
+
+        if frame.nbytes > self.max_frame_bytes:
+            raise ValueError(f"frame is larger than a slot ({frame.nbytes} > {self.max_frame_bytes} bytes)")
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        seq = int(self.header[2]) + 1
+        slot = (seq - 1) % self.slots
+
+        height = frame.shape[0]
+        width = frame.shape[1] if frame.ndim > 1 else 1
+        channels = frame.shape[2] if frame.ndim > 2 else 1
+
+        if image_size is None:
+            image_size = (width, height)
+
+        # The slot is marked as being written, so a reader holding an older view of it can tell
+        self.slot_ints[slot, 0] = -1
+
+        self.data[slot, :frame.nbytes].reshape(frame.shape)[...] = frame
+
+        self.slot_ints[slot, 1:8] = (height, width, channels, frame.nbytes, encoding, image_size[0], image_size[1])
+        self.slot_floats[slot, 0] = timestamp
+        self.slot_floats[slot, 1] = fps
+        self.slot_ints[slot, 0] = seq
+
+        # Publish
+        self.header[2] = seq
+
+        return seq
+
+
+    def read(self, last_seq=0):
+
+        seq = int(self.header[2])
+
+        if seq <= last_seq:
+            return False, np.array([]), None, last_seq
+
+        slot = (seq - 1) % self.slots
+
+        height, width, channels, nbytes = (int(v) for v in self.slot_ints[slot, 1:5])
+        fps = float(self.slot_floats[slot, 1])
+
+        if channels > 1:
+            shape = (height, width, channels)
+        elif width > 1:
+            shape = (height, width)
+        else:
+            shape = (height,)
+
+        frame = self.data[slot, :nbytes].reshape(shape)
+
+        if not self.isValid(seq):
+            return False, np.array([]), None, last_seq
+
+        return True, frame, fps, seq
+
+
+    def latest(self):
+        return int(self.header[2])
+
+
+    def timestamp(self, seq):
+        # Capture time of frame seq, as long as its slot has not been reused
+        return float(self.slot_floats[(seq - 1) % self.slots, 0])
+
+
+    def encoding(self, seq):
+        # Encoding of frame seq and its image (width, height)
+        slot = (seq - 1) % self.slots
+        return int(self.slot_ints[slot, 5]), (int(self.slot_ints[slot, 6]), int(self.slot_ints[slot, 7]))
+
+
+    def isValid(self, seq):
+        return seq > 0 and int(self.slot_ints[(seq - 1) % self.slots, 0]) == seq
+
+
+    def close(self):
+
+        self.header = None
+        self.slot_ints = None
+        self.slot_floats = None
+        self.data = None
+
+        try:
+            self.shm.close()
+        except BufferError:
+            # A consumer still holds a view of a slot, the mapping goes away with it
+            pass
+
+
+    def unlink(self):
+        self.shm.unlink()
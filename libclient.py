@@ -1,182 +1,140 @@
 import sys
 import selectors
-import json
-import io
-import struct
+import socket
 import numpy as np
 import cv2
 from collections import defaultdict
 import copy
 import time
+import os
+from concurrent.futures import ThreadPoolExecutor
 
+from utils import Pacer, LatencyHistogram, ClockOffset
+from libmessage import Encode_Message, Decode_Message, Recv_Buffer, Send_Buffer
 
-class Encode_Message:
 
-    def encode_message(self, content, content_type, content_encoding, content_description):
-        
-        # Input Checker for content_type
-        self.__content_types = ["json", "binary"]
-        if not (content_type in self.__content_types):
-            raise ValueError(f"content_type must be one of {self.__content_types}")
-
-        # Input Checker for content_encoding
-        self.content_encodings = ["utf-8"]
-        if not (content_encoding in self.content_encodings):
-            raise ValueError(f"content_encoding must be one of {self.content_encodings}")
-
-        # Input Checker for content_description
-        if type(content_description) is not dict:
-            raise ValueError(f"content_description must be dict")
-
-        for reqhdr in ["action"]:
-            if reqhdr not in content_description:
-                raise ValueError(f"Missing required key in content_description: '{reqhdr}'.")
-
-
-        self.__content = content
-        self.__content_type = content_type
-        self.__content_encoding = content_encoding
-        self.__content_description = content_description
-
-
-        if self.__content_type == "json":
-            self.__content_bytes = self.__json_encode(self.__content, self.__content_encoding)
-        elif self.__content_type == "binary":
-            self.__content_bytes = self.__content
-
-
-        self.__jsonheader = {
-            "content-type": self.__content_type,
-            "content-encoding": self.__content_encoding,
-            "content-length": len(self.__content_bytes),
-            "content-description": self.__content_description
-        } 
-
-        self.__jsonheader_bytes = self.__json_encode(self.__jsonheader, "utf-8")
+# Stages of a frame from capture to decoded image. Times of the server are brought to the
+# client clock with the offset estimated by Ping/Pong, so stages crossing the network are only
+# counted once there is an estimate.
+LATENCY_STAGES = ("capture->encode", "encode", "encode->enqueue", "enqueue->recieve", "decode", "capture->decoded")
 
 
-        self.__jsonheader_len = len(self.__jsonheader_bytes)
-        self.__jsonheader_len_bytes = struct.pack(">L", self.__jsonheader_len)
+def decode_frame(img_encoded_bytes, frame_info):
 
-        self.__message = self.__jsonheader_len_bytes + self.__jsonheader_bytes + self.__content_bytes
+    # Returns the BGR image of a frame (None if it can not be decoded) and the time it was ready.
+    # Raw frames are views of the received bytes; cv2.imdecode can not decode into a given
+    # array, so other codecs get a new image.
 
-        self.__send_buffer = self.__message
+    img_encoded = np.frombuffer(img_encoded_bytes, dtype='uint8')
 
-        return self.__send_buffer
+    # Older servers only send webp
+    if frame_info.get("codec", "webp") == "raw":
+        img_BGR = img_encoded.reshape(frame_info["height"], frame_info["width"], frame_info["channels"])
+    else:
+        img_BGR = cv2.imdecode(img_encoded, cv2.IMREAD_COLOR)
 
+    return img_BGR, time.time()
 
-    def __json_encode(self, obj, encoding):
-        # json is text (string)
-        # json_str = json.dumps(obj) -->  python object to json string 
-        # obj = json.loads(json_str) -->  json string to python object
-        # Possible Objects: dict, list, tuple, string, int, float, True, False, None
-        # 
-        return json.dumps(obj, ensure_ascii=False).encode(encoding)
 
+class Decoder_Pool:
 
+    # Decodes frames in worker threads (cv2 releases the GIL), so the socket keeps being read
+    # while large frames decode and several streams use several cores. A stream has at most one
+    # frame being decoded, which keeps its frames in order; a frame arriving meanwhile waits,
+    # and replaces the one waiting before it, so a client that falls behind skips frames
+    # instead of falling further behind. A finished decoding signals the wakeup.
 
-class Decode_Message:
+    def __init__(self, workers=None, wakeup=None):
 
-    def __init__(self):
+        if workers is None:
+            workers = os.cpu_count() or 1
 
-        self.jsonheader_len = None
-        self.jsonheader = None
-        self.content = None
-        self.content_description = None
-        self.content_type = None
+        if (not isinstance(workers, int)) or workers <= 0:
+            raise ValueError("workers must be a positive integer")
 
-    
-    def decode_message(self, _recv_buffer):
-
-        _recv_buffer = self.decode_jsonheader_len(_recv_buffer)
-        _recv_buffer = self.decode_jsonheader(_recv_buffer)
-        _recv_buffer = self.decode_content(_recv_buffer)
-
-        return _recv_buffer, self.content, self.content_description, self.content_type
+        self.wakeup = wakeup
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decoder")
 
+        # Per (owner, stream): (future, frame_info, t_recieved) being decoded, and
+        # (content, frame_info, t_recieved) waiting. The owner is the connection, which
+        # forgets its frames when it closes.
+        self.__decoding = {}
+        self.__waiting = {}
+        self.dropped_frames = 0
 
-    def decode_jsonheader_len(self, _recv_buffer):
 
-        if self.jsonheader_len is None:
-            hdrlen = 4
-            if len(_recv_buffer) >= hdrlen:
+    def submit(self, owner, stream, content, frame_info, t_recieved):
 
-                jsonheader_len_bytes = _recv_buffer[:hdrlen]
-                _recv_buffer = _recv_buffer[hdrlen:]
+        # Returns True if a waiting frame of the stream was dropped for this one
 
-                self.jsonheader_len = struct.unpack(">L", jsonheader_len_bytes)[0]
-
-        return _recv_buffer
-
-            
+        stream = (owner, stream)
+        dropped = False
 
-    def decode_jsonheader(self, _recv_buffer):
-
-        if self.jsonheader_len is not None:
-            if self.jsonheader is None:
-
-                hdrlen = self.jsonheader_len
+        if stream in self.__decoding:
+            if stream in self.__waiting:
+                self.dropped_frames += 1
+                dropped = True
+            self.__waiting[stream] = (content, frame_info, t_recieved)
+        else:
+            self.__start(stream, content, frame_info, t_recieved)
 
-                if len(_recv_buffer) >= hdrlen:
+        return dropped
 
-                    jsonheader_bytes = _recv_buffer[:hdrlen]
-                    _recv_buffer = _recv_buffer[hdrlen:]
 
-                    self.jsonheader = self.__json_decode(jsonheader_bytes, "utf-8")
+    def __start(self, stream, content, frame_info, t_recieved):
 
-                    for reqhdr in ("content-type", "content-encoding", "content-length", "content-description"):
-                        if reqhdr not in self.jsonheader:
-                            raise ValueError(f"Missing required header '{reqhdr}'.")
+        future = self.__executor.submit(decode_frame, content, frame_info)
 
-        return _recv_buffer
+        if self.wakeup is not None:
+            future.add_done_callback(lambda _: self.wakeup.signal())
 
+        self.__decoding[stream] = (future, frame_info, t_recieved)
 
-    def decode_content(self, _recv_buffer):
 
-        if self.jsonheader:
-            if self.content is None:
+    def results(self, owner):
 
-                content_length = self.jsonheader["content-length"]
-                self.content_type = self.jsonheader["content-type"]
-                self.content_description = self.jsonheader["content-description"]
+        # Yields (stream, image, frame_info, t_recieved, t_decoded) of the finished decodings of an owner
 
+        for stream, (future, frame_info, t_recieved) in list(self.__decoding.items()):
 
-                if not len(_recv_buffer) >= content_length:
-                    return _recv_buffer
+            if stream[0] is not owner or not future.done():
+                continue
 
-                content_bytes = _recv_buffer[:content_length]
-                _recv_buffer = _recv_buffer[content_length:]
+            del self.__decoding[stream]
 
-                if self.content_type == "json":
+            if stream in self.__waiting:
+                self.__start(stream, *self.__waiting.pop(stream))
 
-                    content_encoding = self.jsonheader["content-encoding"]
-                    self.content = self.__json_decode(content_bytes, content_encoding)
+            img_BGR, t_decoded = future.result()
+            yield stream[1], img_BGR, frame_info, t_recieved, t_decoded
 
-                elif self.content_type == "binary":
-                    self.content = content_bytes
-                else:
-                    pass
 
-        return _recv_buffer
+    def forget(self, owner):
 
+        # Drops the frames of an owner, those being decoded finish but nobody gets them
 
-    def __json_decode(self, json_bytes, encoding): # encoding = "utf-8"
-        tiow = io.TextIOWrapper(
-            io.BytesIO(json_bytes), encoding=encoding, newline=""
-        )
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
+        for streams in (self.__decoding, self.__waiting):
+            for stream in [stream for stream in streams if stream[0] is owner]:
+                del streams[stream]
 
 
+    def close(self):
+        self.__waiting = {}
+        self.__executor.shutdown(wait=True, cancel_futures=True)
 
 
 class Message:
     
 
-    def __init__(self, selector, sock, addr, request_description, video_shower):
+    def __init__(self, selector, sock, addr, request_description, video_shower, ping_period=2, report_period=10,
+                 idle_timeout=30, decoders=None, recorder=None, credits=None):
 
+        # Frames go to the video shower and/or the recorder, they are not decoded without a video shower
         self.video_shower = video_shower
+        self.recorder = recorder
+
+        # Frames are decoded right away without a Decoder_Pool
+        self.decoders = decoders
         
         self.cap_idx = 0
 
@@ -184,14 +142,34 @@ class Message:
         self.sock = sock
         self.addr = addr
 
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self._recv_buffer = Recv_Buffer()
+        self._send_buffer = Send_Buffer()
         
         self.Recieving_Message = Decode_Message()
         self.Sending_Message= Encode_Message()
 
-        self.request_description = request_description
+        # Pings double as heartbeats, the server closes the connection if they stop
+        self.request_description = dict(request_description)
+        self.request_description.setdefault("heartbeat", ping_period)
+
+        # With credits the server sends a stream only as many frames as it was granted, and a
+        # credit goes back for every frame shown or recorded. Without, it sends all it samples.
+        self.credits = credits
+        self.__credits_due = {}
+        if credits is not None:
+            self.request_description.setdefault("credits", credits)
         self.__isRequestSent = False
+        self.__events_mode = "rw"
+
+        self.clock = ClockOffset()
+        self.latency = {stage: LatencyHistogram() for stage in LATENCY_STAGES}
+        self.__ping_pacer = Pacer(1 / ping_period)
+        self.__report_pacer = Pacer(1 / report_period)
+        self.__report_pacer.tick()
+
+        # The server answers every ping, so silence for this long means it is gone
+        self.idle_timeout = idle_timeout
+        self.__t_recieved = time.monotonic()
 
 
     def _set_selector_events_mask(self, mode):
@@ -205,31 +183,36 @@ class Message:
         else:
             raise ValueError(f"Invalid events mask mode {mode!r}.")
         self.selector.modify(self.sock, events, data=self)
+        self.__events_mode = mode
+
+    def _update_events_mask(self):
+        # Write interest is only armed while there is something to send
+        mode = "rw" if (self._send_buffer or not self.__isRequestSent) else "r"
+        if mode != self.__events_mode:
+            self._set_selector_events_mask(mode)
 
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            received = self._recv_buffer.recv_into(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not received:
                 raise RuntimeError("Peer closed.")
 
+            self.__t_recieved = time.monotonic()
+
     def _write(self):
         if self._send_buffer:
             print(f"Sending message to {self.addr}")
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                self._send_buffer.send(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
-            else:
-                self._send_buffer = self._send_buffer[sent:]
 
 
 
@@ -242,70 +225,196 @@ class Message:
             self.process_request()
             self._write()
 
+        self._update_events_mask()
+
+    def poll(self):
+
+        # Called by the client loop on every iteration, for decoded frames and the periodic
+        # pings and reports
+
+        if not self.__isRequestSent:
+            return
+
+        self.process_decoded()
+        self.send_credits()
+
+        if time.monotonic() - self.__t_recieved > self.idle_timeout:
+            raise RuntimeError("Server timed out.")
+
+        if self.__ping_pacer.ready():
+            self.__ping_pacer.tick()
+            self.send_control("Ping", {"t0": time.time()})
+
+        if self.__report_pacer.ready():
+            self.__report_pacer.tick()
+            self.report_latency()
+
     def process_response(self):
 
-        self._recv_buffer, response, response_description, response_type = self.Recieving_Message.decode_message(self._recv_buffer)
-        
-        if response is not None:
+        # All complete messages are handled, not only the first one, since frames
+        # often arrive in bursts
 
-        
-            #################################################################
-            if response_description["action"] == "HereIsFrame":
-                if response_type != "binary":
-                    raise TypeError("content-type for action 'HereIsFrame' must be binary")
-
-                if not ("frame-info" in response_description):
-                    raise ValueError("frame-info is not in response_description")
-                
-                print( f"Received message: {len(response)//1000} KB from {self.addr} ")
-                
-        
+        count = 0
 
-                t1 = time.time()
+        for response, response_description, response_type in self.Recieving_Message.decode_messages(self._recv_buffer):
+            self.process_message(response, response_description, response_type, time.time())
+            count += 1
 
+        self.send_credits()
 
-                length = response_description["frame-info"]["length"]
+        return count
 
+    def process_message(self, response, response_description, response_type, t_recieved=None):
 
-                img_encoded_bytes = response[:length]
-                response = response[length:]
+        if t_recieved is None:
+            t_recieved = time.time()
 
+        #################################################################
+        if response_description["action"] == "HereIsFrame":
+            if response_type != "binary":
+                raise TypeError("content-type for action 'HereIsFrame' must be binary")
 
-                img_encoded = np.frombuffer(img_encoded_bytes, dtype='uint8')
-                img_BGR = cv2.imdecode(img_encoded,1)
-                
-                
-                self.video_shower.newFrame(img_BGR, "1")
-                
+            if not ("frame-info" in response_description):
+                raise ValueError("frame-info is not in response_description")
+            
+            print( f"Received message: {len(response)//1000} KB from {self.addr} ")
 
-                print("time of getting images:", time.time() - t1)
-                            
-                        
+
+            frame_info = response_description["frame-info"]
+            length = frame_info["length"]
+
+            # Frames of every camera of the connection come mixed, the stream id tells them apart
+            stream = frame_info.get("stream-id", 1)
+
+            # A view of the receive buffer, it is not copied before decoding
+            img_encoded_bytes = response[:length]
+
+            # Recorded as it was received
+            if self.recorder is not None:
+                self.recorder.write(stream, frame_info, img_encoded_bytes, t_recieved)
+
+            if self.video_shower is None:
+                self.consumed(stream)
+            elif self.decoders is None:
+                img_BGR, t_decoded = decode_frame(img_encoded_bytes, frame_info)
+                self.show_frame(stream, img_BGR, frame_info, t_recieved, t_decoded)
+            elif self.decoders.submit(self, stream, img_encoded_bytes, frame_info, t_recieved):
+                # The frame waiting before this one will not be shown
+                self.consumed(stream)
+
+        elif response_description["action"] == "CameraStatus":
+
+            if response["status"] == "offline":
+                print(f"Camera {response['stream-id']} offline, reconnecting in {response['retry-in']} s (attempt {response['attempts']})")
             else:
-                pass
+                print(f"Camera {response['stream-id']} {response['status']}")
+
+        elif response_description["action"] == "Pong":
+
+            self.clock.add(response["t0"], response["t1"], response["t2"], t_recieved)
+                        
+        elif response_description["action"] in ("StreamAccepted", "HereIsCapabilities"):
+
+            # The codec used for the stream, and the ones the server supports
+            print(f"{response_description['action']}: {response}")
+                    
+        else:
+            pass
+        ##################################################################
+
+    def process_decoded(self):
+
+        # Frames decoded by the pool since the last call, the pool may be shared by connections
+
+        if self.decoders is None:
+            return
+
+        for stream, img_BGR, frame_info, t_recieved, t_decoded in self.decoders.results(self):
+            self.show_frame(stream, img_BGR, frame_info, t_recieved, t_decoded)
+
+    def show_frame(self, stream, img_BGR, frame_info, t_recieved, t_decoded):
+
+        self.consumed(stream)
+
+        if img_BGR is None:
+            print(f"Frame {frame_info.get('seq')} of stream {stream} could not be decoded")
+            return
+
+        self.video_shower.newFrame(img_BGR, str(stream))
+
+        print("time of getting images:", t_decoded - t_recieved)
 
-            self.Recieving_Message = Decode_Message()
-            self.response = None
-            ##################################################################
+        self.add_latency(frame_info, t_recieved, t_decoded)
+
+    def consumed(self, stream):
+        if self.credits is not None:
+            self.__credits_due[stream] = self.__credits_due.get(stream, 0) + 1
+
+    def send_credits(self):
+
+        # Credits of the frames consumed since the last call, in one message for all streams
+        if self.__credits_due:
+            self.send_control("Credit", {"credits": {str(stream): n for stream, n in self.__credits_due.items()}})
+            self.__credits_due = {}
+
+    def add_latency(self, frame_info, t_recieved, t_decoded):
+
+        # Older servers do not send all of the times
+        capture = frame_info.get("capture-time")
+        encode_end = frame_info.get("encode-time")
+        encode_start = frame_info.get("encode-start", encode_end)
+        enqueue = frame_info.get("enqueue-time") or encode_end
+
+        if capture is None or encode_end is None:
+            return
+
+        self.latency["capture->encode"].add(encode_start - capture)
+        self.latency["encode"].add(encode_end - encode_start)
+        self.latency["encode->enqueue"].add(enqueue - encode_end)
+        self.latency["decode"].add(t_decoded - t_recieved)
+
+        if self.clock.isValid():
+            self.latency["enqueue->recieve"].add(t_recieved - self.clock.toLocal(enqueue))
+            self.latency["capture->decoded"].add(t_decoded - self.clock.toLocal(capture))
+
+    def report_latency(self):
+
+        if self.clock.isValid():
+            print(f"Clock offset of {self.addr}: {1000 * self.clock.offset:.1f} ms, rtt: {1000 * self.clock.rtt:.1f} ms")
+
+        for stage in LATENCY_STAGES:
+            print(f"Latency {stage}: {self.latency[stage].summary()}")
+            self.latency[stage].reset()
+
+    def send_control(self, action, content):
+
+        self._send_buffer.append(*self.Sending_Message.encode_segments(content = content,
+                                                                       content_type = "json",
+                                                                       content_encoding = "utf-8",
+                                                                       content_description = {"action": action}))
+        self._update_events_mask()
 
     def process_request(self):
         if not self.__isRequestSent:
 
-            request_bytes = self.Sending_Message.encode_message(content = b'nothing', 
-                                                                content_type = "binary",
-                                                                content_encoding = "utf-8",
-                                                                content_description = self.request_description)
-            self._send_buffer += request_bytes
+            request_segments = self.Sending_Message.encode_segments(content = b'nothing', 
+                                                                  content_type = "binary",
+                                                                  content_encoding = "utf-8",
+                                                                  content_description = self.request_description)
+            self._send_buffer.append(*request_segments)
             self.__isRequestSent = True       
-        
-        if self.__isRequestSent:
-            if not self._send_buffer:
-                # Set selector to listen for read events, we're done writing.
-                self._set_selector_events_mask("r")
 
 
     def close(self):
+
+        if self.sock is None:
+            return
+
         print(f"Closing connection to {self.addr}")
+
+        if self.decoders is not None:
+            self.decoders.forget(self)
+
         try:
             self.selector.unregister(self.sock)
         except Exception as e:
@@ -314,6 +423,12 @@ class Message:
                 f"{self.addr}: {e!r}"
             )
 
+        # Ends the connection even if a process forked meanwhile holds a copy of the socket
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
         try:
             self.sock.close()
         except OSError as e:
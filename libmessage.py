@@ -0,0 +1,553 @@
+import json
+import os
+import struct
+import time
+from collections import deque, defaultdict
+from itertools import islice
+
+
+# Frame messages can carry a fixed layout binary header instead of the json header. It is
+# flagged by the highest bit of the 4 bytes header length, and only sent to clients that ask
+# for it with "frame-header": "binary" in their request.
+#
+# version, codec, stream id, seq, capture time, encode time, width, height, channels, length
+FRAME_HEADER = struct.Struct(">BBHQddHHBI")
+FRAME_HEADER_FLAG = 0x80000000
+
+# Version 2 appends encode start and enqueue time, encode time being the end of the encoding.
+# The enqueue time is written per connection, right before the frame goes to the send queue.
+FRAME_HEADER_V2 = struct.Struct(">dd")
+FRAME_HEADER_VERSION = 2
+FRAME_HEADER_ENQUEUE_OFFSET = 4 + FRAME_HEADER.size + 8
+FRAME_HEADER_STREAM_OFFSET = 4 + 2
+
+# Codecs the server can encode to and their ids in binary frame headers, the lossy ones take
+# a quality between 1 and 100
+CODECS = {"webp": 1, "jpeg": 2, "png": 3, "raw": 4}
+CODEC_NAMES = {v: k for k, v in CODECS.items()}
+LOSSY_CODECS = tuple(codec for codec in CODECS if codec in ("webp", "jpeg"))
+
+
+
+class Encode_Message:
+
+    def encode_message(self, content, content_type, content_encoding, content_description):
+
+        header_bytes, content_bytes = self.encode_segments(content, content_type, content_encoding, content_description)
+        return header_bytes + content_bytes
+
+
+    def encode_segments(self, content, content_type, content_encoding, content_description):
+
+        # Returns (header, content) without joining them, so the content is not copied
+        
+        # Input Checker for content_type
+        self.__content_types = ["json", "binary"]
+        if not (content_type in self.__content_types):
+            raise ValueError(f"content_type must be one of {self.__content_types}")
+
+        # Input Checker for content_encoding
+        self.content_encodings = ["utf-8"]
+        if not (content_encoding in self.content_encodings):
+            raise ValueError(f"content_encoding must be one of {self.content_encodings}")
+
+        # Input Checker for content_description
+        if type(content_description) is not dict:
+            raise ValueError(f"content_description must be dict")
+
+        for reqhdr in ["action"]:
+            if reqhdr not in content_description:
+                raise ValueError(f"Missing required key in content_description: '{reqhdr}'.")
+
+
+        self.__content = content
+        self.__content_type = content_type
+        self.__content_encoding = content_encoding
+        self.__content_description = content_description
+
+
+        if self.__content_type == "json":
+            self.__content_bytes = self.__json_encode(self.__content, self.__content_encoding)
+        elif self.__content_type == "binary":
+            self.__content_bytes = self.__content
+
+
+        self.__jsonheader = {
+            "content-type": self.__content_type,
+            "content-encoding": self.__content_encoding,
+            "content-length": len(self.__content_bytes),
+            "content-description": self.__content_description
+        } 
+
+        self.__jsonheader_bytes = self.__json_encode(self.__jsonheader, "utf-8")
+
+
+        self.__jsonheader_len = len(self.__jsonheader_bytes)
+        self.__jsonheader_len_bytes = struct.pack(">L", self.__jsonheader_len)
+
+        self.__header_bytes = self.__jsonheader_len_bytes + self.__jsonheader_bytes
+
+        return self.__header_bytes, self.__content_bytes
+
+
+    def encode_frame_segments(self, content, frame_info):
+
+        # Returns (header, content) of a frame message with a binary header
+
+        header_bytes = FRAME_HEADER.pack(FRAME_HEADER_VERSION,
+                                         CODECS[frame_info["codec"]],
+                                         frame_info["stream-id"],
+                                         frame_info["seq"],
+                                         frame_info["capture-time"],
+                                         frame_info["encode-time"],
+                                         frame_info["width"],
+                                         frame_info["height"],
+                                         frame_info["channels"],
+                                         len(content))
+
+        header_bytes += FRAME_HEADER_V2.pack(frame_info.get("encode-start", frame_info["encode-time"]),
+                                             frame_info.get("enqueue-time", 0.0))
+
+        return struct.pack(">L", FRAME_HEADER_FLAG | len(header_bytes)) + header_bytes, content
+
+
+    def stamp_frame_header(self, header_bytes, stream_id=None, enqueue_time=None):
+
+        # Returns a copy of a binary frame header (from encode_frame_segments) with the stream id
+        # and the enqueue time of a connection set, the header itself is shared by every
+        # connection watching the camera
+
+        if enqueue_time is None:
+            enqueue_time = time.time()
+
+        header = bytearray(header_bytes)
+        struct.pack_into(">d", header, FRAME_HEADER_ENQUEUE_OFFSET, enqueue_time)
+
+        if stream_id is not None:
+            struct.pack_into(">H", header, FRAME_HEADER_STREAM_OFFSET, stream_id)
+
+        return header
+
+
+    def __json_encode(self, obj, encoding):
+        # json is text (string)
+        # json_str = json.dumps(obj) -->  python object to json string 
+        # obj = json.loads(json_str) -->  json string to python object
+        # Possible Objects: dict, list, tuple, string, int, float, True, False, None
+        # 
+        return json.dumps(obj, ensure_ascii=False).encode(encoding)
+
+
+
+
+class Decode_Message:
+
+    # Single pass parser: every call takes as much of the next message as is available in the
+    # Recv_Buffer and returns it once it is complete. Binary content is returned as a memoryview
+    # of the receive buffer, without copying.
+
+    def __init__(self):
+        self.__reset()
+
+
+    def __reset(self):
+
+        self.jsonheader_len = None
+        self.jsonheader = None
+        self.frameheader_len = None
+
+    
+    def decode_message(self, recv_buffer):
+
+        # jsonheader length
+        if self.jsonheader_len is None and self.frameheader_len is None:
+
+            hdrlen = 4
+            if len(recv_buffer) < hdrlen:
+                return None, None, None
+
+            hdrlen = struct.unpack(">L", recv_buffer.consume(hdrlen))[0]
+
+            if hdrlen & FRAME_HEADER_FLAG:
+                self.frameheader_len = hdrlen & ~FRAME_HEADER_FLAG
+            else:
+                self.jsonheader_len = hdrlen
+
+        # binary frame header
+        if self.frameheader_len is not None:
+            return self.__decode_frame(recv_buffer)
+
+        # jsonheader
+        if self.jsonheader is None:
+
+            hdrlen = self.jsonheader_len
+            if len(recv_buffer) < hdrlen:
+                recv_buffer.expect(hdrlen)
+                return None, None, None
+
+            self.jsonheader = self.__json_decode(recv_buffer.consume(hdrlen), "utf-8")
+
+            for reqhdr in ("content-type", "content-encoding", "content-length", "content-description"):
+                if reqhdr not in self.jsonheader:
+                    raise ValueError(f"Missing required header '{reqhdr}'.")
+
+        # content
+        content_length = self.jsonheader["content-length"]
+        if len(recv_buffer) < content_length:
+            # The rest of the content is received right after what is already buffered
+            recv_buffer.expect(content_length)
+            return None, None, None
+
+        content_bytes = recv_buffer.consume(content_length)
+
+        content_type = self.jsonheader["content-type"]
+        content_description = self.jsonheader["content-description"]
+
+        if content_type == "json":
+            content = self.__json_decode(content_bytes, self.jsonheader["content-encoding"])
+        elif content_type == "binary":
+            content = content_bytes
+        else:
+            content = None
+
+        self.__reset()
+
+        return content, content_description, content_type
+
+
+    def decode_messages(self, recv_buffer):
+
+        # Yields every complete message in recv_buffer, the last incomplete one stays
+        # in the buffer for the next call
+        while True:
+
+            content, content_description, content_type = self.decode_message(recv_buffer)
+
+            if content is None:
+                return
+
+            yield content, content_description, content_type
+
+
+    def __decode_frame(self, recv_buffer):
+
+        if self.jsonheader is None:
+
+            hdrlen = self.frameheader_len
+            if len(recv_buffer) < hdrlen:
+                return None, None, None
+
+            # Newer versions may append fields, only the known ones are read
+            header_bytes = recv_buffer.consume(hdrlen)
+            (version, codec, stream_id, seq, capture_time, encode_time,
+             width, height, channels, length) = FRAME_HEADER.unpack_from(header_bytes)
+
+            frame_info = {
+                "length": length,
+                "codec": CODEC_NAMES.get(codec),
+                "stream-id": stream_id,
+                "seq": seq,
+                "capture-time": capture_time,
+                "encode-time": encode_time,
+                "width": width,
+                "height": height,
+                "channels": channels
+            }
+
+            if version >= 2 and hdrlen >= FRAME_HEADER.size + FRAME_HEADER_V2.size:
+                frame_info["encode-start"], frame_info["enqueue-time"] = FRAME_HEADER_V2.unpack_from(header_bytes, FRAME_HEADER.size)
+
+            self.jsonheader = {
+                "content-type": "binary",
+                "content-encoding": "utf-8",
+                "content-length": length,
+                "content-description": {"action": "HereIsFrame", "frame-info": frame_info}
+            }
+
+        content_length = self.jsonheader["content-length"]
+        if len(recv_buffer) < content_length:
+            recv_buffer.expect(content_length)
+            return None, None, None
+
+        content = recv_buffer.consume(content_length)
+        content_description = self.jsonheader["content-description"]
+
+        self.__reset()
+
+        return content, content_description, "binary"
+
+
+    def __json_decode(self, json_bytes, encoding): # encoding = "utf-8"
+        return json.loads(str(json_bytes, encoding))
+
+
+
+class Recv_Buffer:
+
+    # Growable receive buffer filled in place with recv_into.
+    # Bytes handed out by consume() are never overwritten: when there is not enough free space
+    # left, the unconsumed bytes are moved to a new bytearray, so the memoryviews returned by
+    # the parser stay valid for as long as they are referenced.
+
+    def __init__(self, read_size=4096, min_read_size=4096, max_read_size=1048576):
+
+        self.read_size = read_size
+        self.min_read_size = min_read_size
+        self.max_read_size = max_read_size
+
+        self.__buffer = bytearray(4 * read_size)
+        self.__view = memoryview(self.__buffer)
+        self.__start = 0
+        self.__end = 0
+
+
+    def __len__(self):
+        return self.__end - self.__start
+
+
+    def expect(self, n):
+        # Makes sure the next n bytes fit in the buffer without moving them again
+        self.__reserve(n - len(self))
+
+
+    def __reserve(self, n):
+
+        if len(self.__buffer) - self.__end >= n:
+            return
+
+        length = len(self)
+        size = len(self.__buffer)
+        if length + n > size:
+            size = max(2 * size, length + n)
+
+        buffer = bytearray(size)
+        buffer[:length] = self.__view[self.__start:self.__end]
+
+        self.__buffer = buffer
+        self.__view = memoryview(buffer)
+        self.__start = 0
+        self.__end = length
+
+
+    def recv_into(self, sock):
+
+        self.__reserve(self.read_size)
+
+        nbytes = len(self.__buffer) - self.__end
+        received = sock.recv_into(self.__view[self.__end:], nbytes)
+        self.__end += received
+
+        # Adapt the read size to how much the socket had to give
+        if received >= self.read_size:
+            self.read_size = min(2 * self.read_size, self.max_read_size)
+        elif received < self.read_size // 4:
+            self.read_size = max(self.read_size // 2, self.min_read_size)
+
+        return received
+
+
+    def consume(self, n):
+
+        if n > len(self):
+            raise ValueError("Not enough bytes in the buffer")
+
+        data = self.__view[self.__start:self.__start + n]
+        self.__start += n
+
+        return data
+
+
+
+class Send_Buffer:
+
+    # Queue of messages, each a list of buffer segments written with sendmsg (one iovec per
+    # segment), so headers and payloads go out as they are, without being joined or re-sliced
+    # after a partial send.
+    #
+    # Frames can be bounded in count and bytes: when a new frame does not fit, queued frames
+    # that have not started to be sent are dropped, oldest first, so a slow client always gets
+    # the newest frame instead of drifting into the past. Frames of several streams can share
+    # the buffer, the count bound is per stream and frames of the same stream are dropped first.
+    # Other streams only make room for bytes: a frame is dropped from the stream with the most
+    # frames queued, the new frame counted, so no stream starves the others.
+
+    try:
+        IOV_MAX = min(os.sysconf("SC_IOV_MAX"), 1024)
+    except (AttributeError, ValueError, OSError):
+        IOV_MAX = 16
+
+    def __init__(self, max_frames=None, max_bytes=None):
+
+        if max_frames is not None and ((not isinstance(max_frames, int)) or max_frames <= 0):
+            raise ValueError("max_frames must be a positive integer or None")
+
+        if max_bytes is not None and ((not isinstance(max_bytes, int)) or max_bytes <= 0):
+            raise ValueError("max_bytes must be a positive integer or None")
+
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+
+        # [segments, length, isFrame, stream] per message
+        self.__messages = deque()
+        self.__length = 0
+        self.__frames = 0
+        self.__stream_frames = defaultdict(int)
+        self.__started = False
+
+        # Counters
+        self.sent_bytes = 0
+        self.sent_frames = 0
+        self.dropped_frames = 0
+        self.__stream_dropped = defaultdict(int)
+
+
+    def __len__(self):
+        return self.__length
+
+
+    def frames(self, stream=None):
+        # Number of queued frames (of a stream), including a partially sent one
+        if stream is None:
+            return self.__frames
+        return self.__stream_frames[stream]
+
+
+    def dropped(self, stream=None):
+        if stream is None:
+            return self.dropped_frames
+        return self.__stream_dropped[stream]
+
+
+    def append(self, *segments, isFrame=False, stream=None):
+
+        # Returns the streams of the frames dropped to make room, including the stream of
+        # this frame if it is the one dropped
+
+        segments = deque(memoryview(segment).cast("B") for segment in segments if len(segment))
+        length = sum(len(segment) for segment in segments)
+
+        if not length:
+            return []
+
+        dropped = []
+
+        if isFrame:
+            dropped, isQueued = self.__make_room(length, stream)
+            if not isQueued:
+                return dropped
+            self.__frames += 1
+            self.__stream_frames[stream] += 1
+
+        self.__messages.append([segments, length, isFrame, stream])
+        self.__length += length
+
+        return dropped
+
+
+    def __over_frames(self, stream):
+        return self.max_frames is not None and self.__stream_frames[stream] + 1 > self.max_frames
+
+
+    def __over_bytes(self, length):
+        return self.max_bytes is not None and self.__length + length > self.max_bytes
+
+
+    def __droppable(self, stream=None):
+
+        # Indexes of the queued frames (of a stream), oldest first. A partially sent message
+        # can not be dropped without corrupting the stream
+        start = 1 if self.__started else 0
+
+        return [i for i in range(start, len(self.__messages))
+                if self.__messages[i][2] and (stream is None or self.__messages[i][3] == stream)]
+
+
+    def __drop(self, i):
+
+        _, length, _, stream = self.__messages[i]
+        del self.__messages[i]
+
+        self.__length -= length
+        self.__frames -= 1
+        self.__stream_frames[stream] -= 1
+        self.dropped_frames += 1
+        self.__stream_dropped[stream] += 1
+
+        return stream
+
+
+    def __make_room(self, length, stream):
+
+        # Returns the streams of the dropped frames, and whether the new frame is queued
+        dropped = []
+
+        # Frames of the same stream go first
+        while self.__over_frames(stream) or self.__over_bytes(length):
+            frames = self.__droppable(stream)
+            if not frames:
+                break
+            dropped.append(self.__drop(frames[0]))
+
+        # Frames of other streams only make room for bytes, the frames of a stream can not
+        # fix its own count. The victim is the stream with the most frames, the new one
+        # counted, then the one that lost the fewest; if that is the new frame, it goes.
+        while self.__over_bytes(length):
+
+            frames = self.__droppable()
+            if not frames:
+                break
+
+            candidates = [self.__messages[i][3] for i in frames] + [stream]
+            victim = max(candidates, key=lambda s: (self.__stream_frames[s] + (s == stream), -self.__stream_dropped[s]))
+
+            if victim == stream:
+                self.dropped_frames += 1
+                self.__stream_dropped[stream] += 1
+                dropped.append(stream)
+                return dropped, False
+
+            dropped.append(self.__drop(frames[candidates.index(victim)]))
+
+        return dropped, True
+
+
+    def send(self, sock):
+
+        if hasattr(sock, "sendmsg"):
+            segments = []
+            for message in self.__messages:
+                segments.extend(islice(message[0], self.IOV_MAX - len(segments)))
+                if len(segments) >= self.IOV_MAX:
+                    break
+            sent = sock.sendmsg(segments)
+        else:
+            sent = sock.send(self.__messages[0][0][0])
+
+        self.__length -= sent
+        self.sent_bytes += sent
+
+        # Drop what is sent, a partially sent segment is only re-sliced as a memoryview
+        left = sent
+        while left:
+
+            message = self.__messages[0]
+            segments = message[0]
+            segment = segments[0]
+            self.__started = True
+
+            if left >= len(segment):
+                left -= len(segment)
+                segments.popleft()
+            else:
+                segments[0] = segment[left:]
+                left = 0
+
+            if not segments:
+                self.__messages.popleft()
+                self.__started = False
+                if message[2]:
+                    self.__frames -= 1
+                    self.__stream_frames[message[3]] -= 1
+                    self.sent_frames += 1
+
+        return sent
@@ -2,201 +2,234 @@ from shutil import ExecError
 from signal import raise_signal
 import sys
 import selectors
-import json
-import io
-import struct
+import socket
 import time
-import copy
+from functools import partial
 
-from camera import ManageFPS, CameraGetterCV2MP, ImageEncoding
+from sources import SOURCES, check_address
+from utils import Pacer
+from libmessage import Encode_Message, Decode_Message, Recv_Buffer, Send_Buffer, CODECS
 
 
 class CameraHandler(Exception):
     pass
 
 
-class Encode_Message:
-
-    def encode_message(self, content, content_type, content_encoding, content_description):
-        
-        # Input Checker for content_type
-        self.__content_types = ["json", "binary"]
-        if not (content_type in self.__content_types):
-            raise ValueError(f"content_type must be one of {self.__content_types}")
-
-        # Input Checker for content_encoding
-        self.content_encodings = ["utf-8"]
-        if not (content_encoding in self.content_encodings):
-            raise ValueError(f"content_encoding must be one of {self.content_encodings}")
-
-        # Input Checker for content_description
-        if type(content_description) is not dict:
-            raise ValueError(f"content_description must be dict")
-
-        for reqhdr in ["action"]:
-            if reqhdr not in content_description:
-                raise ValueError(f"Missing required key in content_description: '{reqhdr}'.")
-
-
-        self.__content = content
-        self.__content_type = content_type
-        self.__content_encoding = content_encoding
-        self.__content_description = content_description
-
-
-        if self.__content_type == "json":
-            self.__content_bytes = self.__json_encode(self.__content, self.__content_encoding)
-        elif self.__content_type == "binary":
-            self.__content_bytes = self.__content
+# Renditions as (quality, scale, rate factor), from the best to the lightest. Connections only
+# move along this ladder, so clients on the same rung share the same encoded frames.
+RENDITION_LADDER = [
+    (90, 1.0, 1.0),
+    (75, 1.0, 1.0),
+    (50, 1.0, 1.0),
+    (50, 0.75, 1.0),
+    (40, 0.5, 1.0),
+    (30, 0.5, 0.5),
+    (20, 0.25, 0.5),
+    (20, 0.25, 0.25),
+]
 
 
-        self.__jsonheader = {
-            "content-type": self.__content_type,
-            "content-encoding": self.__content_encoding,
-            "content-length": len(self.__content_bytes),
-            "content-description": self.__content_description
-        } 
+class Adaptive_Rendition:
 
-        self.__jsonheader_bytes = self.__json_encode(self.__jsonheader, "utf-8")
+    # Steps a connection down the ladder while its send queue backs up or drops frames,
+    # and back up once the queue has stayed empty for a while. The throughput measured while
+    # the queue backed up is taken as the capacity of the link, and a step up waits until the
+    # current throughput leaves room for the next rung, or until the queue has stayed empty
+    # long enough to probe again.
 
+    UP_HEADROOM = 1.5
 
-        self.__jsonheader_len = len(self.__jsonheader_bytes)
-        self.__jsonheader_len_bytes = struct.pack(">L", self.__jsonheader_len)
+    def __init__(self, quality, samplingRate, quality_min=None, quality_max=None, scale_min=1.0,
+                 samplingRate_min=None, check_period=1.0, up_after=3):
 
-        self.__message = self.__jsonheader_len_bytes + self.__jsonheader_bytes + self.__content_bytes
+        quality_min = quality if quality_min is None else quality_min
+        quality_max = quality if quality_max is None else quality_max
+        samplingRate_min = samplingRate if samplingRate_min is None else samplingRate_min
 
-        self.__send_buffer = self.__message
+        self.ladder = [(q, scale, rate) for q, scale, rate in RENDITION_LADDER
+                       if quality_min <= q <= quality_max and scale >= scale_min and samplingRate * rate >= samplingRate_min]
 
-        return self.__send_buffer
+        # The requested quality gets a full size rung of its own, in the order of the ladder
+        if quality_min <= quality <= quality_max and (quality, 1.0, 1.0) not in self.ladder:
+            self.ladder.append((quality, 1.0, 1.0))
+            self.ladder.sort(key=lambda rendition: (-rendition[2], -rendition[1], -rendition[0]))
 
+        # Without room to adapt, the requested rendition is used as it is
+        if not self.ladder:
+            self.ladder = [(quality, 1.0, 1.0)]
 
-    def __json_encode(self, obj, encoding):
-        # json is text (string)
-        # json_str = json.dumps(obj) -->  python object to json string 
-        # obj = json.loads(json_str) -->  json string to python object
-        # Possible Objects: dict, list, tuple, string, int, float, True, False, None
-        # 
-        return json.dumps(obj, ensure_ascii=False).encode(encoding)
+        # Start from the rung closest to the requested quality, the largest one of equally close rungs
+        self.rung = min(range(len(self.ladder)), key=lambda i: (abs(self.ladder[i][0] - quality),
+                                                                -self.ladder[i][1], -self.ladder[i][2]))
 
+        self.samplingRate = samplingRate
+        self.check_period = check_period
+        self.up_after = up_after
 
+        self.__t_check = time.monotonic()
+        self.__dropped = 0
+        self.__sent_bytes = 0
+        self.__calm_periods = 0
+        self.throughput = 0
+        self.capacity = None
 
-class Decode_Message:
 
-    def __init__(self):
+    def get(self):
+        # (quality, scale, samplingRate) of the current rung
+        quality, scale, rate = self.ladder[self.rung]
+        return quality, scale, self.samplingRate * rate
 
-        self.jsonheader_len = None
-        self.jsonheader = None
-        self.content = None
-        self.content_description = None
-        self.content_type = None
 
-    
-    def decode_message(self, _recv_buffer):
+    def update(self, send_buffer, stream=None):
 
-        _recv_buffer = self.decode_jsonheader_len(_recv_buffer)
-        _recv_buffer = self.decode_jsonheader(_recv_buffer)
-        _recv_buffer = self.decode_content(_recv_buffer)
+        # Returns True if the rendition has changed, only frames of the stream count
 
-        print(
-            f"Received {self.jsonheader} "
-        )
+        now = time.monotonic()
+        if now - self.__t_check < self.check_period:
+            return False
 
-        return _recv_buffer, self.content, self.content_description, self.content_type
+        dropped = send_buffer.dropped(stream) - self.__dropped
+        self.throughput = (send_buffer.sent_bytes - self.__sent_bytes) / (now - self.__t_check)
 
-    def decode_jsonheader_len(self, _recv_buffer):
+        self.__t_check = now
+        self.__dropped = send_buffer.dropped(stream)
+        self.__sent_bytes = send_buffer.sent_bytes
 
-        if self.jsonheader_len is None:
-            hdrlen = 4
-            if len(_recv_buffer) >= hdrlen:
+        rung = self.rung
 
-                jsonheader_len_bytes = _recv_buffer[:hdrlen]
-                _recv_buffer = _recv_buffer[hdrlen:]
+        if dropped > 0 or send_buffer.frames(stream) > 1:
+            self.__calm_periods = 0
+            self.capacity = self.throughput
+            rung = min(rung + 1, len(self.ladder) - 1)
 
-                self.jsonheader_len = struct.unpack(">L", jsonheader_len_bytes)[0]
+        elif send_buffer.frames(stream) == 0:
+            self.__calm_periods += 1
 
-        return _recv_buffer
+            fits = self.capacity is None or self.throughput * self.UP_HEADROOM <= self.capacity
+            probe = self.__calm_periods >= 3 * self.up_after
 
-            
+            if self.__calm_periods >= self.up_after and (fits or probe):
+                self.__calm_periods = 0
+                if probe:
+                    self.capacity = None
+                rung = max(rung - 1, 0)
 
-    def decode_jsonheader(self, _recv_buffer):
+        if rung == self.rung:
+            return False
 
-        if self.jsonheader_len is not None:
-            if self.jsonheader is None:
+        self.rung = rung
+        print(f"Rendition {self.get()} at {round(self.throughput / 1000)} KB/s")
+        return True
 
-                hdrlen = self.jsonheader_len
 
-                if len(_recv_buffer) >= hdrlen:
+class Stream:
 
-                    jsonheader_bytes = _recv_buffer[:hdrlen]
-                    _recv_buffer = _recv_buffer[hdrlen:]
+    # One camera of a connection, with its own codec, rendition and sampling. Frames are tagged
+    # with the stream id the client gave it, so a connection can carry several cameras.
 
-                    self.jsonheader = self.__json_decode(jsonheader_bytes, "utf-8")
+    def __init__(self, stream_id, camera, codec, rendition, frame_header, credits=None):
 
-                    for reqhdr in ("content-type", "content-encoding", "content-length", "content-description"):
-                        if reqhdr not in self.jsonheader:
-                            raise ValueError(f"Missing required header '{reqhdr}'.")
+        self.stream_id = stream_id
+        self.camera = camera
+        self.codec = codec
+        self.rendition = rendition
+        self.frame_header = frame_header
+        self.pacer = Pacer(rendition.get()[2])
 
-        return _recv_buffer
+        # Frames the client is ready for, it grants more with Credit messages as it consumes
+        # them. None for clients without flow control, which get every sampled frame.
+        self.credits = credits
 
+        self.last_seq = 0
+        self.isEncoding = False
+        self.t_sampled = None
+        self.camera_state = None
 
-    def decode_content(self, _recv_buffer):
+        # Binary headers are shared by all connections and get the stream id per connection,
+        # json ones are framed per stream id
+        self.framing = "binary" if frame_header == "binary" else ("json", stream_id)
 
-        if self.jsonheader:
-            if self.content is None:
 
-                content_length = self.jsonheader["content-length"]
-                self.content_type = self.jsonheader["content-type"]
-                self.content_description = self.jsonheader["content-description"]
+def parse_stream(spec, media_root=None):
 
+    # Settings of a stream from its part of a SendCamFrames request
 
-                if not len(_recv_buffer) >= content_length:
-                    return _recv_buffer
+    # RTSP, MJPEG (JPEGs of an MJPEG over HTTP camera are forwarded without decoding),
+    # FILE, IMAGES or SYNTHETIC, see sources.py
+    video_format = spec["format"]
+    if video_format not in SOURCES:
+        raise ValueError(f"Format {video_format!r} is not supported, one of {tuple(SOURCES)} is expected")
 
-                content_bytes = _recv_buffer[:content_length]
-                _recv_buffer = _recv_buffer[content_length:]
+    # Paths only under the media root of the server
+    address = check_address(video_format, spec["address"], media_root)
 
-                if self.content_type == "json":
+    # Older clients only send "webp", the quality of a webp stream
+    codec = spec.get("codec", "webp")
+    quality = spec.get("quality", spec.get("webp", 75))
 
-                    content_encoding = self.jsonheader["content-encoding"]
-                    self.content = self.__json_decode(content_bytes, content_encoding)
+    if codec not in CODECS:
+        print(f"Codec {codec!r} is not supported, falling back to webp")
+        codec = "webp"
 
-                elif self.content_type == "binary":
-                    self.content = content_bytes
-                else:
-                    pass
+    for name, value in (("quality", quality), ("quality-min", spec.get("quality-min")), ("quality-max", spec.get("quality-max"))):
+        if value is not None and (isinstance(value, bool) or (not isinstance(value, int)) or not 1 <= value <= 100):
+            raise ValueError(f"{name} must be an integer between 1 and 100")
 
-        return _recv_buffer
+    # Bounds of the adaptive rendition, by default the requested one is kept
+    rendition = Adaptive_Rendition(quality=quality,
+                                   samplingRate=spec["samplingRate"],
+                                   quality_min=spec.get("quality-min"),
+                                   quality_max=spec.get("quality-max"),
+                                   scale_min=spec.get("scale-min", 1.0),
+                                   samplingRate_min=spec.get("samplingRate-min"))
 
+    # Newer clients ask for binary frame headers, older ones get json
+    frame_header = spec.get("frame-header", "json")
+    if frame_header not in ("json", "binary"):
+        raise ValueError("frame-header must be json or binary")
 
+    stream_id = spec.get("id")
+    if stream_id is not None and ((not isinstance(stream_id, int)) or not 0 <= stream_id <= 0xFFFF):
+        raise ValueError("id of a camera must be an integer between 0 and 65535")
 
-    def __json_decode(self, json_bytes, encoding): # encoding = "utf-8"
-        tiow = io.TextIOWrapper(
-            io.BytesIO(json_bytes), encoding=encoding, newline=""
-        )
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
+    # Initial credit of the stream
+    credits = spec.get("credits")
+    if credits is not None and ((not isinstance(credits, int)) or credits < 0):
+        raise ValueError("credits must be a non-negative integer")
 
+    return {"id": stream_id, "format": video_format, "address": address, "codec": codec,
+            "quality": quality, "rendition": rendition, "frame-header": frame_header, "credits": credits}
 
- 
 
 class Message:
 
-    def __init__(self, selector, sock, addr, cam):
+    def __init__(self, selector, sock, addr, cameras, max_queue_frames=2, max_queue_bytes=8000000, idle_timeout=30):
 
-        self.cam = cam
+        self.cameras = cameras
+        # Stream per stream id
+        self.streams = {}
         
         self.selector = selector
         self.sock = sock
         self.addr = addr
 
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self._recv_buffer = Recv_Buffer()
+        # Latest frame wins when the client can not keep up
+        self._send_buffer = Send_Buffer(max_frames=max_queue_frames, max_bytes=max_queue_bytes)
 
         self.Recieving_Message = Decode_Message()
         self.Sending_Message= Encode_Message()
 
-        self.__isRequestRecieved = False
+        self.__events_mode = "r"
+
+        # A peer is dead when it sends nothing for idle_timeout before its stream is accepted or
+        # while it promised heartbeats, or when queued frames do not move for idle_timeout (it
+        # stopped reading)
+        self.idle_timeout = idle_timeout
+        self.heartbeat_timeout = None
+        self.__isAccepted = False
+        self.__t_recieved = time.monotonic()
+        self.__t_sent = time.monotonic()
 
 
     def _set_selector_events_mask(self, mode):
@@ -211,11 +244,19 @@ class Message:
             raise ValueError(f"Invalid events mask mode {mode!r}.")
         # self in data=self means the Message instance itself            
         self.selector.modify(self.sock, events, data=self)                          
+        self.__events_mode = mode
+
+    def _update_events_mask(self):
+        # Write interest is only armed while there is something to send, otherwise
+        # select() would return immediately forever
+        mode = "rw" if self._send_buffer else "r"
+        if mode != self.__events_mode:
+            self._set_selector_events_mask(mode)
 
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            received = self._recv_buffer.recv_into(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
@@ -225,22 +266,37 @@ class Message:
             # Connection is     established and client is     sending data
             # Connection is     established and client is not sending data
             # Connection is not established
-            if data:                                                               
-                self._recv_buffer += data
-            else:
+            if not received:
                 raise RuntimeError("Peer closed.")
 
+            self.__t_recieved = time.monotonic()
+
     def _write(self):
         if self._send_buffer:
             print(f"Sending message to {self.addr}")
             try:
                 # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                if self._send_buffer.send(self.sock):
+                    self.__t_sent = time.monotonic()
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass
-            else:
-                self._send_buffer = self._send_buffer[sent:]
+
+    def _deadline(self):
+        # Monotonic time at which the peer is considered dead, None if it can not be yet
+        deadlines = []
+        if not self.__isAccepted:
+            deadlines.append(self.__t_recieved + self.idle_timeout)
+        if self.heartbeat_timeout is not None:
+            deadlines.append(self.__t_recieved + self.heartbeat_timeout)
+        if self._send_buffer:
+            deadlines.append(self.__t_sent + self.idle_timeout)
+        return min(deadlines, default=None)
+
+    def check_timeout(self):
+        deadline = self._deadline()
+        if deadline is not None and time.monotonic() > deadline:
+            raise RuntimeError("Peer timed out.")
 
     def process_events(self, mask):
 
@@ -249,16 +305,33 @@ class Message:
             self._read()
             self.process_request()
 
-        # It seems that when EVENT_WRITE is selected, this line will always (?) be run
+        # Only selected while _send_buffer is not empty
         if mask & selectors.EVENT_WRITE:
-            self.process_response()
             self._write()
 
+        self._update_events_mask()
+
+    def time_left(self):
+        # Seconds until the next frame is due for this connection or until it times out,
+        # None if it only has to wait for a new frame (the selector is woken up by the cameras for that)
+        time_lefts = [stream.pacer.time_left() for stream in self.streams.values()]
+        deadline = self._deadline()
+        if deadline is not None:
+            time_lefts.append(max(0.0, deadline - time.monotonic()) + 0.001)
+        time_lefts = [t for t in time_lefts if t > 0]
+        return min(time_lefts, default=None)
+
     def process_request(self):
         
-        self._recv_buffer, request, request_description, request_type = self.Recieving_Message.decode_message(self._recv_buffer)
+        for request, request_description, request_type in self.Recieving_Message.decode_messages(self._recv_buffer):
+
+            t_recieved = time.time()
 
-        if request is not None:
+            # Credits come with every frame the client consumes
+            if request_description.get("action") != "Credit":
+                print(
+                    f"Received {request_description} "
+                )
 
             ##################################################################
             if request_description["action"] == "SendCamFrames":
@@ -266,118 +339,247 @@ class Message:
                 if request_type != "binary":
                     raise TypeError("content-type for action 'SendCamFrames' must be binary")
 
+                # Clients sending a heartbeat (any message, e.g. Ping) every that many seconds
+                # are closed after missing a few of them
+                heartbeat = request_description.get("heartbeat")
+                if heartbeat is not None and ((not isinstance(heartbeat, (int, float))) or heartbeat <= 0):
+                    raise ValueError("heartbeat must be a positive number of seconds")
 
-                video_format = request_description["format"]
+                # A list of cameras, each with its own settings falling back to the ones of the
+                # request, or a single camera described by the request itself
+                common = {k: v for k, v in request_description.items() if k != "cameras"}
+                specs = [dict(common, **camera) for camera in request_description.get("cameras", [common])]
 
-                if video_format == "RTSP":
+                try:
+                    specs = [parse_stream(spec, self.cameras.media_root) for spec in specs]
+                except (KeyError, ValueError) as e:
+                    print(f"Invalid camera configuration: {e!r}")
+                    raise CameraHandler
 
-                    cam_address = request_description["address"]
-                    cam_SR = request_description["samplingRate"]
-                    webp = request_description["webp"]
+                ids = [spec["id"] for spec in specs if spec["id"] is not None]
+                if len(ids) != len(set(ids)):
+                    print("Stream ids must be unique")
+                    raise CameraHandler
 
+                print("New Camera Configuration...")
 
-                    # cond1 = True #prev_resolution!=resolution
-                    # cond2 = True# prev_cameraFPS!=cameraFPS
-                    # cond3 = True #prev_samplingFPS!=samplingFPS
-                    # cond4 = True #prev_webp!=webp
-                    # cond5 = True #not all([(ID in IDs) for ID in prev_IDs])
-                    # cond6 = True #not all([(ID in prev_IDs) for ID in IDs])
-                    # cond = cond1 or cond2 or cond3 or cond4 or cond5 or cond6
+                # The new cameras replace the old ones. They are subscribed first, so a camera
+                # kept with other settings is not stopped and started again.
+                streams = {}
 
-                    # if cond:
+                try:
 
-                    print("New Camera Configuration...")
+                    for spec in specs:
 
-                    try:
+                        camera = self.cameras.subscribe(spec["address"], spec["format"])
 
-                        # info = self.cam_info.get(IDs=IDs,
-                        #                         resolution=resolution,
-                        #                         showIDs=None,
-                        #                         side=self.server_loc)
-                        # self.cam.stop()
+                        # Without an id, a stream is tagged with the camera id, as before
+                        stream_id = spec["id"] if spec["id"] is not None else int(camera.ID)
+                        if stream_id in streams:
+                            self.cameras.unsubscribe(camera)
+                            raise ValueError(f"Stream id {stream_id} is used twice")
 
-                        self.cam = CameraGetterCV2MP(ID="1", cam_address="http://77.222.181.11:8080/mjpg/video.mjpg") #Camera()
-                        self.cam.start()
-                        # self.cam.start(camera_info=info,
-                        #             cameraFPS=cameraFPS,
-                        #             samplingFPS=samplingFPS,
-                        #             loggingTime=30,
-                        #             webp=webp)
+                        stream = Stream(stream_id, camera, spec["codec"], spec["rendition"], spec["frame-header"],
+                                        spec["credits"])
+                        camera.setRate(stream, stream.rendition.get()[2])
+                        streams[stream_id] = stream
 
-                        self.manageFPS = ManageFPS(cam_SR)
+                except:
+                    print("An Error occured during camera configuration")
+                    self.close_streams(streams)
+                    raise CameraHandler
 
-                    except:
-                        print("An Error occured during camera configuration")
-                        raise CameraHandler
-                
-                    # else:
-                    #     print("Same Configuration for cameras...")
+                streams, self.streams = self.streams, streams
+                self.close_streams(streams)
+
+                self.heartbeat_timeout = None if heartbeat is None else max(self.idle_timeout, 3 * heartbeat)
+
+                self.send_control("StreamAccepted", {"codec": specs[0]["codec"],
+                                                     "quality": specs[0]["quality"],
+                                                     "codecs": list(CODECS),
+                                                     "streams": [{"id": stream.stream_id,
+                                                                  "camera": int(stream.camera.ID),
+                                                                  "codec": stream.codec,
+                                                                  "quality": stream.rendition.get()[0],
+                                                                  "credits": stream.credits}
+                                                                 for stream in self.streams.values()]})
+                self.__isAccepted = True
+
+            elif request_description["action"] == "GetCapabilities":
+
+                self.send_control("HereIsCapabilities", {"codecs": list(CODECS), "formats": list(SOURCES)})
+
+            elif request_description["action"] == "Credit":
 
+                # More frames the client is ready for, by stream id
+                for stream_id, credits in request["credits"].items():
+
+                    stream = self.streams.get(int(stream_id))
+
+                    if stream is not None and stream.credits is not None:
+                        stream.credits += int(credits)
+
+            elif request_description["action"] == "Heartbeat":
+
+                # Only keeps the connection alive
+                pass
+
+            elif request_description["action"] == "Ping":
+
+                # For the client to estimate the offset of the server clock, t0 is its send time
+                self.send_control("Pong", {"t0": request["t0"], "t1": t_recieved, "t2": time.time()})
 
             else:
                 # Other actions
                 pass
             ##################################################################
-
-            self.__isRequestRecieved = True
         
 
     def process_response(self):
 
-        if self.__isRequestRecieved :
+        # Called by the server loop whenever a camera has a new frame, an encoding is done
+        # or a sampling deadline passes
+
+        self.check_timeout()
+
+        for stream in self.streams.values():
 
             ##################################################################
 
-            if not (self.manageFPS.still_wait()):
+            self.send_camera_state(stream)
+
+            if stream.rendition.update(self._send_buffer, stream.stream_id):
+                stream.pacer.setRate(stream.rendition.get()[2])
+                stream.camera.setRate(stream, stream.rendition.get()[2])
+
+            if stream.isEncoding:
+
+                # The frame sampled before is still being encoded
+                self.send_frame(stream)
+
+            elif stream.pacer.ready() and stream.credits != 0:
 
-                t1 = time.time()
-                # areAllCamerasChecked, frames = self.cam.get_frames(encode_and_tobytes=True)
-                frameIsAvailable, frame, _ = self.cam.getFrame()
+                frameIsAvailable, _, _, seq = stream.camera.getFrame(stream.last_seq)
                 
                 if frameIsAvailable:
 
-                    frame_copy = copy.deepcopy(frame)
+                    # Starts the next sampling period
+                    stream.pacer.tick()
+                    stream.last_seq = seq
 
-                    encoders = ImageEncoding()
-                    encoders.start(frame_copy, True, 50)
+                    if stream.credits is not None:
+                        stream.credits -= 1
 
-                    encoders.stop()
-                    frame_encoded = encoders.get_encoded()
-                
-                
-                
-                    t2 = time.time()
+                    stream.t_sampled = time.time()
+                    stream.isEncoding = True
+                    self.send_frame(stream)
 
-                
 
-                    print("time of getting frames: ", round(t2-t1, 3))
-                    
-                    content = b''
+    def send_frame(self, stream):
+
+        # Encoded and framed once per (camera, frame, codec, quality, scale), the same bytes
+        # are shared with every other connection watching this camera
+        quality, scale, _ = stream.rendition.get()
+        response_segments = stream.camera.getEncoded(stream.codec, quality, partial(self.frame_message, stream=stream),
+                                                     stream.framing, scale)
+
+        if response_segments is None:
+            return
+
+        stream.isEncoding = False
+
+        print("time of getting frames: ", round(time.time() - stream.t_sampled, 3))
+
+        # Binary headers carry the stream id and the time the frame was queued for this connection
+        if stream.frame_header == "binary":
+            header, content = response_segments
+            response_segments = (self.Sending_Message.stamp_frame_header(header, stream.stream_id), content)
+
+        self.__queue_started()
+        dropped = self._send_buffer.append(*response_segments, isFrame=True, stream=stream.stream_id)
+
+        # The client never sees the frames dropped to make room, so their credit comes back
+        for stream_id in dropped:
+            dropped_stream = self.streams.get(stream_id)
+            if dropped_stream is not None and dropped_stream.credits is not None:
+                dropped_stream.credits += 1
+
+        self._update_events_mask()
+
 
-                    frame_info = {
-                        "length": len(frame_encoded)
-                    }
+    def send_camera_state(self, stream):
 
-                    content = content + frame_encoded
+        # Subscribers hear about outages instead of just getting no frames, once per state
+        # and reconnection attempt
+        state, attempts, retry_in = stream.camera.getState()
 
-                    
-                    content_description = {
-                        "action": "HereIsFrame",
-                        "frame-info": frame_info
-                    }
-                    ##################################################################
+        if (state, attempts) != stream.camera_state:
+            stream.camera_state = (state, attempts)
+            self.send_control("CameraStatus", {"stream-id": stream.stream_id,
+                                               "status": state,
+                                               "attempts": attempts,
+                                               "retry-in": round(retry_in, 1)})
 
 
-                    response_bytes = self.Sending_Message.encode_message(content = content, 
-                                                                        content_type = "binary",
-                                                                        content_encoding = "utf-8",
-                                                                        content_description = content_description)
+    def send_control(self, action, content):
 
-                    self._send_buffer += response_bytes
+        # Control messages are always json and are never dropped
+        self.__queue_started()
+        self._send_buffer.append(*self.Sending_Message.encode_segments(content = content,
+                                                                       content_type = "json",
+                                                                       content_encoding = "utf-8",
+                                                                       content_description = {"action": action}))
+        self._update_events_mask()
+
+
+    def __queue_started(self):
+        # The stall timeout of the send queue counts from when it stops being empty
+        if not self._send_buffer:
+            self.__t_sent = time.monotonic()
+
+
+    def close_streams(self, streams=None):
+
+        # The streams of the connection by default
+        if streams is None:
+            streams, self.streams = self.streams, {}
+
+        for stream in streams.values():
+            stream.camera.setRate(stream, None)
+            self.cameras.unsubscribe(stream.camera)
+
+
+    def frame_message(self, frame_encoded, frame_info, stream):
+
+        frame_info = dict(frame_info)
+        frame_info["length"] = len(frame_encoded)
+        frame_info["stream-id"] = stream.stream_id
+
+        if stream.frame_header == "binary":
+            return self.Sending_Message.encode_frame_segments(frame_encoded, frame_info)
+
+        content_description = {
+            "action": "HereIsFrame",
+            "frame-info": frame_info
+        }
+
+        # Header and payload stay separate segments all the way to sendmsg
+        return self.Sending_Message.encode_segments(content = frame_encoded, 
+                                                    content_type = "binary",
+                                                    content_encoding = "utf-8",
+                                                    content_description = content_description)
 
     
     def close(self):
+
+        # Safe to call more than once, e.g. from the error handler and the shutdown
+        if self.sock is None:
+            return
+
         print(f"Closing connection to {self.addr}")
+        print(f"Frames sent: {self._send_buffer.sent_frames}, dropped: {self._send_buffer.dropped_frames}")
+
+        self.close_streams()
 
         try:
             self.selector.unregister(self.sock)
@@ -387,6 +589,13 @@ class Message:
                 f"{self.addr}: {e!r}"
             )
 
+        # Capture processes forked while the socket was open hold copies of it, so closing
+        # only this one would not end the connection
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
         try:
             self.sock.close()
         except OSError as e:
@@ -0,0 +1,179 @@
+import argparse
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+
+# A local stand-in for an MJPEG over HTTP camera: serves the JPEGs of a recorded MJPEG file
+# (JPEGs one after another, e.g. what ffmpeg writes with -f mjpeg) in a loop, at a given fps.
+
+
+def read_jpegs(path):
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    jpegs = []
+    start = data.find(b"\xff\xd8")
+
+    while start != -1:
+        end = data.find(b"\xff\xd9", start + 2)
+        if end == -1:
+            break
+        jpegs.append(data[start:end + 2])
+        start = data.find(b"\xff\xd8", end + 2)
+
+    if not jpegs:
+        raise ValueError(f"No JPEG found in {path}")
+
+    return jpegs
+
+
+
+def make_server(jpegs, port, fps, content_length=True):
+
+    # Without content_length, parts only end at the next boundary, as some cameras send them
+    boundary = "mjpegboundary"
+
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            self.send_response(200)
+            self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={boundary}")
+            self.end_headers()
+
+            t_next = time.monotonic()
+            i = 0
+
+            try:
+
+                while True:
+
+                    jpeg = jpegs[i % len(jpegs)]
+                    i += 1
+
+                    headers = f"--{boundary}\r\nContent-Type: image/jpeg\r\n"
+                    if content_length:
+                        headers += f"Content-Length: {len(jpeg)}\r\n"
+
+                    self.wfile.write(f"{headers}\r\n".encode())
+                    self.wfile.write(jpeg)
+                    self.wfile.write(b"\r\n")
+
+                    t_next += 1 / fps
+                    time.sleep(max(0.0, t_next - time.monotonic()))
+
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+
+    return ThreadingHTTPServer(("0.0.0.0", port), Handler)
+
+
+
+def check(jpegs, port, fps, count=20):
+
+    # Reads the stream back with MjpegSource, every JPEG has to come out whole and in order
+
+    from sources import MjpegSource
+
+    source = MjpegSource(f"http://127.0.0.1:{port}/video.mjpg")
+
+    if not source.open():
+        return False
+
+    first = None
+
+    for i in range(count):
+
+        if not source.grab():
+            print(f"Check failed: the stream ended after {i} frames")
+            source.release()
+            return False
+
+        _, jpeg = source.retrieve()
+        jpeg = jpeg.tobytes()
+
+        if first is None:
+            first = jpegs.index(jpeg) if jpeg in jpegs else -1
+
+        if first < 0 or jpeg != jpegs[(first + i) % len(jpegs)]:
+            print(f"Check failed: frame {i} is not the JPEG that was sent")
+            source.release()
+            return False
+
+    source.release()
+    print(f"Check passed: {count} frames in order")
+    return True
+
+
+
+def main(args):
+
+    jpegs = read_jpegs(args.file)
+
+    print(f"{len(jpegs)} JPEGs from {args.file}")
+
+    server = make_server(jpegs, args.port, args.fps, content_length=not args.no_content_length)
+
+    if args.check:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        isPassed = check(jpegs, args.port, args.fps)
+        server.shutdown()
+        server.server_close()
+        raise SystemExit(0 if isPassed else 1)
+
+    print(f"Serving on http://127.0.0.1:{args.port}/video.mjpg")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Caught keyboard interrupt, exiting")
+    finally:
+        server.server_close()
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--file",
+        type=str,
+        required=True,
+        help="recorded MJPEG file",
+    )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8080,
+        help="port of the HTTP server",
+    )
+
+    parser.add_argument(
+        "--fps",
+        type=float,
+        default=25,
+        help="frames per second",
+    )
+
+    parser.add_argument(
+        "--no_content_length",
+        action="store_true",
+        help="send parts without Content-Length, as some cameras do",
+    )
+
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="read the stream back with MjpegSource and exit, non-zero if frames are lost or out of order",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
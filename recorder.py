@@ -0,0 +1,333 @@
+import argparse
+import bisect
+import mmap
+import os
+import struct
+import time
+from datetime import datetime
+
+from libmessage import CODECS, CODEC_NAMES
+
+
+
+# A recording is a directory of segments. A segment is a .frames file with the encoded frames
+# one after another, as they were received (nothing is decoded or re-encoded), and a .index file
+# with a fixed size record per frame. Records are in the order frames were received, so the
+# receive time only grows and a frame is found by bisecting the memory mapped index.
+#
+# receive time, capture time, seq, stream id, codec, width, height, channels, offset, length
+INDEX_RECORD = struct.Struct("<ddQHBHHBQI")
+
+FRAMES_EXT = ".frames"
+INDEX_EXT = ".index"
+
+
+
+class Recorder:
+
+    # Writes received frames to segments that are rotated every segment_seconds or once they
+    # reach segment_bytes, so a long recording can be pruned or copied a piece at a time.
+
+    def __init__(self, directory, segment_seconds=60, segment_bytes=256000000):
+
+        if (not isinstance(segment_seconds, (int, float))) or segment_seconds <= 0:
+            raise ValueError("segment_seconds must be a positive number")
+
+        if (not isinstance(segment_bytes, int)) or segment_bytes <= 0:
+            raise ValueError("segment_bytes must be a positive integer")
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+
+        self.__frames_file = None
+        self.__index_file = None
+        self.__segment = 0
+        self.__offset = 0
+        self.__t_segment = 0.0
+
+        self.recorded_frames = 0
+        self.recorded_bytes = 0
+
+
+    def __rotate(self):
+
+        self.__close_segment()
+
+        # Names sort in recording order
+        self.__segment += 1
+        name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{self.__segment:06d}"
+        path = os.path.join(self.directory, name)
+
+        self.__frames_file = open(path + FRAMES_EXT, "wb")
+        self.__index_file = open(path + INDEX_EXT, "wb")
+        self.__offset = 0
+        self.__t_segment = time.monotonic()
+
+        print(f"Recording to {path}")
+
+
+    def __close_segment(self):
+
+        if self.__frames_file is not None:
+            self.__frames_file.close()
+            self.__index_file.close()
+
+        self.__frames_file = None
+        self.__index_file = None
+
+
+    def write(self, stream_id, frame_info, content, t_recieved=None):
+
+        # content is the encoded frame, e.g. a memoryview of the receive buffer
+
+        if t_recieved is None:
+            t_recieved = time.time()
+
+        length = len(content)
+
+        if self.__frames_file is None or \
+           time.monotonic() - self.__t_segment >= self.segment_seconds or \
+           (self.__offset and self.__offset + length > self.segment_bytes):
+            self.__rotate()
+
+        self.__frames_file.write(content)
+
+        # The record goes after the frame, so a record always points at a complete frame
+        self.__index_file.write(INDEX_RECORD.pack(t_recieved,
+                                                  frame_info.get("capture-time", 0.0),
+                                                  frame_info.get("seq", 0),
+                                                  stream_id,
+                                                  CODECS.get(frame_info.get("codec", "webp"), 0),
+                                                  frame_info.get("width", 0),
+                                                  frame_info.get("height", 0),
+                                                  frame_info.get("channels", 0),
+                                                  self.__offset,
+                                                  length))
+
+        self.__offset += length
+        self.recorded_frames += 1
+        self.recorded_bytes += length
+
+
+    def flush(self):
+        if self.__frames_file is not None:
+            self.__frames_file.flush()
+            self.__index_file.flush()
+
+
+    def close(self):
+        print(f"Recorded {self.recorded_frames} frames, {self.recorded_bytes // 1000} KB in {self.directory}")
+        self.__close_segment()
+
+
+
+class Segment:
+
+    # A memory mapped segment, frames are memoryviews of the mapping
+
+    def __init__(self, path):
+
+        self.path = path
+
+        with open(path + INDEX_EXT, "rb") as f:
+            index_size = os.fstat(f.fileno()).st_size
+            self.__index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if index_size else None
+
+        with open(path + FRAMES_EXT, "rb") as f:
+            frames_size = os.fstat(f.fileno()).st_size
+            self.__frames = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if frames_size else None
+
+        # Records cut short by a crash, or pointing past the frames that made it to disk, are left out
+        self.count = index_size // INDEX_RECORD.size
+
+        while self.count:
+            info = self.info(self.count - 1)
+            if info["offset"] + info["length"] <= frames_size:
+                break
+            self.count -= 1
+
+
+    def __len__(self):
+        return self.count
+
+
+    def time(self, i):
+        # Receive time of frame i
+        return struct.unpack_from("<d", self.__index, i * INDEX_RECORD.size)[0]
+
+
+    def info(self, i):
+
+        (t_recieved, capture_time, seq, stream_id, codec, width, height, channels,
+         offset, length) = INDEX_RECORD.unpack_from(self.__index, i * INDEX_RECORD.size)
+
+        return {
+            "recieve-time": t_recieved,
+            "capture-time": capture_time,
+            "seq": seq,
+            "stream-id": stream_id,
+            "codec": CODEC_NAMES.get(codec),
+            "width": width,
+            "height": height,
+            "channels": channels,
+            "offset": offset,
+            "length": length
+        }
+
+
+    def frame(self, i):
+        info = self.info(i)
+        return info, memoryview(self.__frames)[info["offset"]:info["offset"] + info["length"]]
+
+
+    def seek(self, t):
+        # First frame received at or after t
+        return bisect.bisect_left(range(self.count), t, key=self.time)
+
+
+    def close(self):
+        for mapping in (self.__index, self.__frames):
+            if mapping is not None:
+                try:
+                    mapping.close()
+                except BufferError:
+                    # A frame is still referenced, the mapping goes away with it
+                    pass
+
+
+
+class Recording:
+
+    # Reads a recording back. Frames are numbered across segments, frame(i) returns
+    # (info, encoded bytes) without copying and seek(t) finds a frame by receive time.
+
+    def __init__(self, directory):
+
+        names = sorted(name[:-len(INDEX_EXT)] for name in os.listdir(directory) if name.endswith(INDEX_EXT))
+
+        self.segments = [segment for segment in (Segment(os.path.join(directory, name)) for name in names) if len(segment)]
+
+        # Number of frames before every segment
+        self.__starts = [0]
+        for segment in self.segments:
+            self.__starts.append(self.__starts[-1] + len(segment))
+
+
+    def __len__(self):
+        return self.__starts[-1]
+
+
+    def __locate(self, i):
+
+        if not 0 <= i < len(self):
+            raise IndexError("frame index out of range")
+
+        s = bisect.bisect_right(self.__starts, i) - 1
+        return self.segments[s], i - self.__starts[s]
+
+
+    def info(self, i):
+        segment, j = self.__locate(i)
+        return segment.info(j)
+
+
+    def frame(self, i):
+        segment, j = self.__locate(i)
+        return segment.frame(j)
+
+
+    def seek(self, t):
+
+        # Index of the first frame received at or after t, len(self) if there is none
+
+        for s, segment in enumerate(self.segments):
+            if segment.time(len(segment) - 1) >= t:
+                return self.__starts[s] + segment.seek(t)
+
+        return len(self)
+
+
+    def frames(self, start_time=None, end_time=None, stream_id=None):
+
+        # Yields (info, encoded bytes) of the frames in [start_time, end_time)
+
+        i = 0 if start_time is None else self.seek(start_time)
+
+        while i < len(self):
+
+            info, content = self.frame(i)
+            i += 1
+
+            if end_time is not None and info["recieve-time"] >= end_time:
+                break
+
+            if stream_id is None or info["stream-id"] == stream_id:
+                yield info, content
+
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+
+def main(args):
+
+    # Summary of a recording, and the frames around a time if asked
+
+    recording = Recording(args.record_dir)
+
+    if not len(recording):
+        print(f"No frames in {args.record_dir}")
+        return
+
+    t_first = recording.info(0)["recieve-time"]
+    t_last = recording.info(len(recording) - 1)["recieve-time"]
+
+    print(f"{len(recording)} frames in {len(recording.segments)} segments, {round(t_last - t_first, 1)} s")
+
+    if args.seek is not None:
+
+        i = recording.seek(t_first + args.seek)
+
+        for j in range(i, min(i + args.count, len(recording))):
+            info, content = recording.frame(j)
+            print(f"{j}: {round(info['recieve-time'] - t_first, 3)} s, stream {info['stream-id']}, seq {info['seq']}, "
+                  f"{info['codec']} {info['width']}x{info['height']}, {len(content)} bytes")
+            del content
+
+    recording.close()
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--record_dir",
+        type=str,
+        required=True,
+        help="directory of the recording",
+    )
+
+    parser.add_argument(
+        "--seek",
+        type=float,
+        default=None,
+        help="seconds from the start of the recording to list frames from",
+    )
+
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=10,
+        help="number of frames to list",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -4,13 +4,14 @@ import selectors
 import traceback
 
 import libserver
-from camera import CameraGetterCV2MP
+from camera import CameraRegistry
 from libserver import CameraHandler
 
 
 
 def main(args):
-    cam = CameraGetterCV2MP(ID="1", cam_address="http://77.222.181.11:8080/mjpg/video.mjpg")
+    cameras = CameraRegistry(encoder_workers=args.encoder_workers, encoder_processes=args.encoder_processes,
+                             media_root=args.media_root)
     # cam_info = CameraInfoArsam()
 
     sel = selectors.DefaultSelector()
@@ -21,10 +22,55 @@ def main(args):
         print(f"Accepted connection from {addr}")
         conn.setblocking(False)
 
-        message = libserver.Message(sel, conn, addr, cam)
-        sel.register(conn, selectors.EVENT_READ | selectors.EVENT_WRITE, data=message)
-        # (HSN) After connection, server would be waiting for a request from client
-        # sel.register(conn, selectors.EVENT_READ, data=message)
+        # Lets the kernel find peers that went away without closing, e.g. a client losing power
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, args.idle_timeout)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+        message = libserver.Message(sel, conn, addr, cameras,
+                                    max_queue_frames=args.max_queue_frames,
+                                    max_queue_bytes=args.max_queue_bytes,
+                                    idle_timeout=args.idle_timeout)
+        # (HSN) After connection, server would be waiting for a request from client.
+        # EVENT_WRITE is only armed by the message while it has something to send.
+        sel.register(conn, selectors.EVENT_READ, data=message)
+
+
+    def messages():
+        return [key.data for key in list(sel.get_map().values()) if isinstance(key.data, libserver.Message)]
+
+
+    def next_timeout():
+        # The selector sleeps until a socket is ready, a camera signals a new frame
+        # or the earliest sampling deadline of the connections passes
+        time_lefts = [t for t in (message.time_left() for message in messages()) if t is not None]
+        return min(time_lefts) if time_lefts else None
+
+
+    def handle(message, mask=None):
+        try:
+            # Core:
+            if mask is None:
+                message.process_response()
+            else:
+                message.process_events(mask)
+
+        except CameraHandler:
+
+            print("Camera configuration failed!")
+
+            message.close()
+            
+        except:
+            print(
+                f"Main: Error: Exception for {message.addr}:\n"
+                f"{traceback.format_exc()}"
+            )
+            # cam_info = message.cam_info
+            
+            message.close()
 
     # Get the local ip of this device and only other programs (as clients) in this device can connect to this program (as server) 
     # host = socket.gethostbyname(socket.gethostname())
@@ -44,6 +90,7 @@ def main(args):
     print(f"Server is listening on {(host, port)}")
     lsock.setblocking(False)
     sel.register(lsock, selectors.EVENT_READ, data=None)
+    sel.register(cameras.wakeup, selectors.EVENT_READ, data=cameras.wakeup)
 
     try:
 
@@ -56,46 +103,36 @@ def main(args):
 
         while True:
 
-            events = sel.select(timeout=None)
+            events = sel.select(timeout=next_timeout())
 
             for key, mask in events:
 
                 if key.data is None:
                     # This section would be executed if a client wants to connect
                     accept_wrapper(key.fileobj)
+
+                elif key.data is cameras.wakeup:
+                    # This section would be executed if a camera has a new frame
+                    cameras.wakeup.drain()
                     
                 else:
-                    # This section would be executed if a client sends data
-                    message = key.data                                                          # message
-                    
-                    try:
-                        # Core:
-                        message.process_events(mask)                                            # message
-
-
-                    except CameraHandler:
-
-                        print("Reseting Cameras!")
-                        cam = CameraGetterCV2MP(ID="1", cam_address="http://77.222.181.11:8080/mjpg/video.mjpg")
+                    # This section would be executed if a client sends data or can receive data
+                    handle(key.data, mask)                                                  # message
 
-                        message.close()
-                        
-                    except:
-                        print(
-                            f"Main: Error: Exception for {message.addr}:\n"
-                            f"{traceback.format_exc()}"
-                        )
-                        cam = message.cam
-                        # cam_info = message.cam_info
-                        
-                        message.close()
-                        
+            # New frames and passed deadlines are turned into responses
+            for message in messages():
+                if message.sock is not None:
+                    handle(message)
 
     except KeyboardInterrupt:
         print("Caught keyboard interrupt, exiting")
 
         
     finally:
+        # Connections first, so every camera is unsubscribed and stopped before the encoders go
+        for message in messages():
+            message.close()
+        cameras.close()
         sel.close()
 
 
@@ -118,6 +155,47 @@ if __name__ == "__main__":
         help="port of connection",
     )
 
+    parser.add_argument(
+        "--max_queue_frames",
+        type=int,
+        default=2,
+        help="maximum number of frames queued for a client, older ones are dropped",
+    )
+
+    parser.add_argument(
+        "--max_queue_bytes",
+        type=int,
+        default=8000000,
+        help="maximum bytes of frames queued for a client, older ones are dropped",
+    )
+
+    parser.add_argument(
+        "--idle_timeout",
+        type=int,
+        default=30,
+        help="seconds after which a client that stopped reading or sending heartbeats is closed",
+    )
+
+    parser.add_argument(
+        "--encoder_workers",
+        type=int,
+        default=None,
+        help="number of encoder workers, by default the number of CPUs",
+    )
+
+    parser.add_argument(
+        "--encoder_processes",
+        action="store_true",
+        help="encode in worker processes instead of threads",
+    )
+
+    parser.add_argument(
+        "--media_root",
+        type=str,
+        default=None,
+        help="directory clients can stream video files and images from, local files are refused without it",
+    )
+
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,451 @@
+import os
+import urllib.request
+import cv2
+import numpy as np
+from framering import SharedFrameRing
+
+
+
+# Frame sources of the capture process. Every source has the interface of cv2.VideoCapture that
+# the capture loop uses: open(), isOpened(), grab(), retrieve() and release(). grab() moves to the
+# next frame and retrieve() decodes (or renders) it, so frames nobody samples stay cheap.
+#
+# encoding tells what retrieve() returns, a BGR image (ENCODING_RAW) or the bytes of a JPEG
+# (ENCODING_JPEG). fps is the rate the source is read at, None for live sources whose grab()
+# blocks until the next frame arrives.
+
+
+def split_rate(address, default=None):
+
+    # "path@25" -> ("path", 25.0), the rate is optional
+
+    head, sep, tail = str(address).rpartition("@")
+
+    if sep:
+        try:
+            return head, float(tail)
+        except ValueError:
+            pass
+
+    return str(address), default
+
+
+
+class FrameSource:
+
+    encoding = SharedFrameRing.ENCODING_RAW
+    fps = None
+
+    def open(self):
+        return True
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        raise NotImplementedError
+
+    def retrieve(self):
+        raise NotImplementedError
+
+    def read(self):
+
+        if not self.grab():
+            return False, None
+
+        return self.retrieve()
+
+    def release(self):
+        pass
+
+
+
+class CV2Source(FrameSource):
+
+    # RTSP and HTTP streams, webcams (an int address) or anything else cv2.VideoCapture opens
+
+    def __init__(self, address):
+
+        self.address = address
+        self.cap = None
+        self.backend = cv2.CAP_ANY
+
+
+    def open(self):
+
+        # Reopened with the backend that worked before instead of trying all of them again
+        self.cap = cv2.VideoCapture(self.address, self.backend)
+
+        if self.cap.isOpened():
+            self.backend = int(self.cap.get(cv2.CAP_PROP_BACKEND))
+            return True
+
+        return False
+
+
+    def isOpened(self):
+        return self.cap is not None and self.cap.isOpened()
+
+
+    def grab(self):
+        return self.cap.grab()
+
+
+    def retrieve(self):
+        return self.cap.retrieve()
+
+
+    def release(self):
+
+        if self.cap is not None:
+            self.cap.release()
+
+        self.cap = None
+
+
+
+class VideoFileSource(CV2Source):
+
+    # A video file played at its own frame rate (or the one after "@" in the address),
+    # starting over at the end
+
+    def __init__(self, address, loop=True):
+
+        path, fps = split_rate(address)
+
+        super().__init__(path)
+        self.loop = loop
+        self.__fps = fps
+
+
+    def open(self):
+
+        if not os.path.isfile(self.address):
+            print("ERROR: Video file", self.address, "not found")
+            return False
+
+        if not super().open():
+            return False
+
+        fps = self.__fps or self.cap.get(cv2.CAP_PROP_FPS)
+        self.fps = fps if fps and fps > 0 else 25.0
+
+        return True
+
+
+    def grab(self):
+
+        if self.cap.grab():
+            return True
+
+        if not self.loop:
+            return False
+
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return self.cap.grab()
+
+
+
+class ImageDirSource(FrameSource):
+
+    # The images of a directory in name order, at the rate after "@" in the address (10 by default)
+
+    EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff")
+
+    def __init__(self, address, loop=True):
+
+        self.path, fps = split_rate(address, 10.0)
+        self.fps = fps
+        self.loop = loop
+        self.files = None
+        self.index = -1
+
+
+    def open(self):
+
+        if not os.path.isdir(self.path):
+            print("ERROR: Image directory", self.path, "not found")
+            return False
+
+        self.files = [os.path.join(self.path, name) for name in sorted(os.listdir(self.path))
+                      if name.lower().endswith(self.EXTENSIONS)]
+
+        if not self.files:
+            print("ERROR: No images in", self.path)
+            self.files = None
+            return False
+
+        self.index = -1
+        return True
+
+
+    def isOpened(self):
+        return self.files is not None
+
+
+    def grab(self):
+
+        if self.index + 1 >= len(self.files) and not self.loop:
+            return False
+
+        self.index = (self.index + 1) % len(self.files)
+        return True
+
+
+    def retrieve(self):
+
+        frame = cv2.imread(self.files[self.index], cv2.IMREAD_COLOR)
+        return frame is not None, frame
+
+
+    def release(self):
+        self.files = None
+
+
+
+class SyntheticSource(FrameSource):
+
+    # A moving colour ramp with the frame number written on it, e.g. "1280x720@30". Frame n is
+    # always the same image, so runs are repeatable, and it costs next to nothing to render.
+
+    def __init__(self, address):
+
+        size, fps = split_rate(address.split("://", 1)[-1], 30.0)
+
+        try:
+            width, height = (int(v) for v in size.lower().split("x"))
+        except ValueError:
+            raise ValueError(f"Synthetic address must be WIDTHxHEIGHT[@FPS], not {address!r}")
+
+        if width <= 0 or height <= 0 or fps <= 0:
+            raise ValueError("Synthetic width, height and fps must be positive")
+
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.index = -1
+        self.__canvas = None
+        self.__frame = None
+
+
+    def open(self):
+
+        # Twice as wide as a frame, frames are windows of it moving to the right
+        x = np.arange(2 * self.width, dtype=np.float32) / self.width
+        y = np.arange(self.height, dtype=np.float32)[:, None] / self.height
+
+        canvas = np.empty((self.height, 2 * self.width, 3), dtype=np.uint8)
+        canvas[..., 0] = (127.5 * (1 + np.sin(2 * np.pi * x))).astype(np.uint8)
+        canvas[..., 1] = (255 * y).astype(np.uint8)
+        canvas[..., 2] = (127.5 * (1 + np.cos(2 * np.pi * (x + y)))).astype(np.uint8)
+
+        self.__canvas = canvas
+        self.__frame = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        self.index = -1
+
+        return True
+
+
+    def isOpened(self):
+        return self.__canvas is not None
+
+
+    def grab(self):
+        self.index += 1
+        return True
+
+
+    def retrieve(self):
+
+        offset = (4 * self.index) % self.width
+        self.__frame[...] = self.__canvas[:, offset:offset + self.width]
+
+        cv2.putText(self.__frame, str(self.index), (10, max(30, self.height // 10)), cv2.FONT_HERSHEY_SIMPLEX,
+                    max(1, self.height // 240), (255, 255, 255), max(1, self.height // 240) * 2)
+
+        return True, self.__frame
+
+
+    def release(self):
+        self.__canvas = None
+        self.__frame = None
+
+
+
+class MjpegSource(FrameSource):
+
+    # Reads the JPEGs of an MJPEG over HTTP (multipart/x-mixed-replace) stream as they are,
+    # without decoding them.
+
+    encoding = SharedFrameRing.ENCODING_JPEG
+
+    def __init__(self, address, timeout=10):
+
+        self.address = address
+        self.timeout = timeout
+        self.__response = None
+        self.__boundary = None
+        self.__jpeg = b""
+
+        # The boundary of the next part was read already, with the end of a part without Content-Length
+        self.__atPart = False
+
+
+    def open(self):
+
+        try:
+            self.__response = urllib.request.urlopen(self.address, timeout=self.timeout)
+
+            content_type = self.__response.headers.get("Content-Type", "")
+            if "boundary=" not in content_type:
+                raise ValueError(f"Not a multipart stream: {content_type!r}")
+
+        except (OSError, ValueError) as e:
+            print("ERROR: Can not open", self.address, ":", e)
+            self.release()
+            return False
+
+        boundary = content_type.split("boundary=", 1)[1].split(";")[0].strip().strip('"')
+        self.__boundary = boundary.lstrip("-").encode()
+        self.__atPart = False
+
+        return True
+
+
+    def isOpened(self):
+        return self.__response is not None
+
+
+    def __isBoundary(self, line):
+        return line.startswith(b"--") and line.strip().lstrip(b"-") == self.__boundary
+
+
+    def grab(self):
+
+        # The JPEG has to be read off the stream anyway, retrieve() only hands it out
+
+        try:
+
+            response = self.__response
+
+            # Part boundary
+            if not self.__atPart:
+                line = response.readline()
+                while line and not self.__isBoundary(line):
+                    line = response.readline()
+
+                if not line:
+                    raise EOFError("Stream ended")
+
+            self.__atPart = False
+
+            # Part headers
+            content_length = None
+            line = response.readline()
+            while line.strip():
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    content_length = int(value.strip())
+                line = response.readline()
+
+            if not line:
+                raise EOFError("Stream ended")
+
+            if content_length is not None:
+                jpeg = response.read(content_length)
+                if len(jpeg) < content_length:
+                    raise EOFError("Stream ended")
+
+            else:
+                # Without Content-Length the part ends at the next boundary
+                lines = []
+                line = response.readline()
+                while line and not self.__isBoundary(line):
+                    lines.append(line)
+                    line = response.readline()
+                jpeg = b"".join(lines).rstrip(b"\r\n")
+                self.__atPart = bool(line)
+
+            self.__jpeg = jpeg
+            return True
+
+        except (OSError, ValueError, EOFError):
+            self.release()
+            return False
+
+
+    def retrieve(self):
+        return True, np.frombuffer(self.__jpeg, dtype=np.uint8)
+
+
+    def release(self):
+
+        if self.__response is not None:
+            try:
+                self.__response.close()
+            except OSError:
+                pass
+
+        self.__response = None
+
+
+
+# Sources by the "format" of a request, the "address" is passed to them
+SOURCES = {
+    "RTSP": CV2Source,
+    "MJPEG": MjpegSource,
+    "FILE": VideoFileSource,
+    "IMAGES": ImageDirSource,
+    "SYNTHETIC": SyntheticSource,
+}
+
+
+# Addresses of these schemes are opened as they are, anything else but a device number
+# is a path on the server
+NETWORK_SCHEMES = ("rtsp", "rtsps", "rtmp", "http", "https")
+
+
+def check_address(video_format, address, media_root=None):
+
+    # Addresses come from clients, so local files are only opened under media_root, the
+    # server's choice. Returns the address to open, with paths resolved, or raises ValueError.
+
+    if video_format == "SYNTHETIC":
+        return address
+
+    if isinstance(address, int) and video_format == "RTSP":
+        # A camera attached to the server
+        return address
+
+    if not isinstance(address, str):
+        raise ValueError("address must be a string")
+
+    scheme, sep, _ = address.partition("://")
+    if sep and scheme.lower() in NETWORK_SCHEMES:
+        if video_format in ("RTSP", "MJPEG"):
+            return address
+        raise ValueError(f"{video_format} address must be a path")
+
+    if video_format == "MJPEG":
+        raise ValueError("MJPEG address must be an http(s) URL")
+
+    if media_root is None:
+        raise ValueError("Local files are disabled, the server has no media root")
+
+    path, rate = split_rate(address) if video_format in ("FILE", "IMAGES") else (address, None)
+
+    root = os.path.realpath(media_root)
+    resolved = os.path.realpath(os.path.join(root, path))
+
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"{path!r} is outside of the media root")
+
+    return resolved if rate is None else f"{resolved}@{address.rpartition('@')[2]}"
+
+
+def open_source(video_format, address):
+
+    if video_format not in SOURCES:
+        raise ValueError(f"video_format must be one of {tuple(SOURCES)}")
+
+    return SOURCES[video_format](address)
@@ -1,5 +1,8 @@
 from datetime import datetime, timezone, timedelta
 import time
+import math
+import random
+from collections import deque
 import base64
 import requests
 from io import BytesIO
@@ -13,29 +16,229 @@ import numpy as np
 
 
 
-class ManageFPS:
-    
-    def __init__(self, fps=1):
+class Pacer:
+
+    # Schedules ticks at a target rate on time.monotonic, so callers can sleep or set select
+    # timeouts until the next deadline instead of polling. Every deadline is one period after
+    # the previous deadline, not after the time the tick was taken, so the long run rate matches
+    # the target. After falling behind by more than max_lag periods, it restarts from now
+    # instead of bursting to catch up.
+
+    def __init__(self, fps=1, max_lag=1):
+
+        self.setRate(fps)
+        self.max_lag = max_lag
+        self.deadline = time.monotonic()
 
 
-        if (not isinstance(fps, (float, int))) or fps  <= 0:
+    def setRate(self, fps):
+
+        if (not isinstance(fps, (float, int))) or fps <= 0:
             raise ValueError("fps must be int or float, and larger than 0")
-        
-        self.DT = 1 / fps
-        self.T1 = time.time()
-        
-    def still_wait(self):
-        
-        self.T2 = time.time()
-        self.dT = self.T2 - self.T1
-        
-        if self.dT < self.DT:
-            return True
-        else:
-            self.T1 = self.T2
-            return False
-        
-        
+
+        self.period = 1 / fps
+
+
+    def time_left(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+
+    def ready(self):
+        return time.monotonic() >= self.deadline
+
+
+    def tick(self):
+
+        # Takes the current tick and returns the next deadline
+
+        now = time.monotonic()
+        self.deadline += self.period
+
+        if now - self.deadline > self.max_lag * self.period:
+            self.deadline = now + self.period
+
+        return self.deadline
+
+
+    def wait(self):
+
+        # Sleeps until the deadline and takes the tick
+
+        time_left = self.time_left()
+        if time_left > 0:
+            time.sleep(time_left)
+
+        return self.tick()
+
+
+class Backoff:
+
+    # Delays between reconnection attempts: the first retry after an outage is immediate, as
+    # most drops are short, then the delay grows by factor up to maximum. Every delay is cut by
+    # up to jitter of itself, so cameras that went down together do not retry together.
+
+    def __init__(self, initial=0.5, maximum=30, factor=2, jitter=0.5):
+
+        if initial <= 0 or maximum < initial or factor < 1 or not 0 <= jitter < 1:
+            raise ValueError("Backoff needs 0 < initial <= maximum, factor >= 1 and 0 <= jitter < 1")
+
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+
+    def next(self):
+
+        self.attempts += 1
+
+        if self.attempts == 1:
+            return 0.0
+
+        delay = min(self.maximum, self.initial * self.factor ** (self.attempts - 2))
+        return delay * (1 - self.jitter * random.random())
+
+
+    def reset(self):
+        self.attempts = 0
+
+
+class Wakeup:
+
+    # A non-blocking pipe that wakes up a selector waiting on it. signal() can be called from
+    # other threads or from forked processes, since they inherit the write end.
+
+    def __init__(self):
+
+        self.__r, self.__w = os.pipe()
+        os.set_blocking(self.__r, False)
+        os.set_blocking(self.__w, False)
+
+
+    def fileno(self):
+        return self.__r
+
+
+    def signal(self):
+        try:
+            os.write(self.__w, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so a wake up is already pending
+            pass
+
+
+    def drain(self):
+        try:
+            while os.read(self.__r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+    def close(self):
+        os.close(self.__r)
+        os.close(self.__w)
+
+
+class LatencyHistogram:
+
+    # Counts latencies in log spaced buckets (4 per doubling, from 0.1 ms), so it keeps no
+    # samples and percentiles come out within a few percent.
+
+    BUCKETS_PER_DOUBLING = 4
+    MIN_LATENCY = 0.0001
+
+    def __init__(self, max_latency=60):
+
+        self.__buckets = [0] * (self.__bucket(max_latency) + 1)
+        self.reset()
+
+
+    def __bucket(self, latency):
+        if latency <= self.MIN_LATENCY:
+            return 0
+        return 1 + int(self.BUCKETS_PER_DOUBLING * math.log2(latency / self.MIN_LATENCY))
+
+
+    def __upper(self, bucket):
+        # Upper bound of a bucket in seconds
+        return self.MIN_LATENCY * 2 ** (bucket / self.BUCKETS_PER_DOUBLING)
+
+
+    def add(self, latency):
+
+        self.__buckets[min(self.__bucket(latency), len(self.__buckets) - 1)] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+
+    def percentile(self, p):
+
+        if not self.count:
+            return None
+
+        rank = p / 100 * self.count
+        seen = 0
+
+        for bucket, n in enumerate(self.__buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(self.__upper(bucket), self.max)
+
+        return self.max
+
+
+    def reset(self):
+
+        self.__buckets[:] = [0] * len(self.__buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def summary(self):
+
+        if not self.count:
+            return "no samples"
+
+        return (f"n={self.count} mean={1000 * self.total / self.count:.1f} "
+                f"p50={1000 * self.percentile(50):.1f} p90={1000 * self.percentile(90):.1f} "
+                f"p99={1000 * self.percentile(99):.1f} max={1000 * self.max:.1f} ms")
+
+
+class ClockOffset:
+
+    # Estimates the offset of a peer's clock (peer - local) from ping/pong exchanges:
+    # t0 local send, t1 peer receive, t2 peer send, t3 local receive. The sample with the
+    # smallest round trip of the last few is used, as it has the least queueing in it.
+
+    def __init__(self, samples=8):
+        self.__samples = deque(maxlen=samples)
+        self.offset = 0.0
+        self.rtt = None
+
+
+    def add(self, t0, t1, t2, t3):
+
+        rtt = (t3 - t0) - (t2 - t1)
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+
+        self.__samples.append((rtt, offset))
+        self.rtt, self.offset = min(self.__samples)
+
+        return self.offset
+
+
+    def isValid(self):
+        return self.rtt is not None
+
+
+    def toLocal(self, peer_time):
+        return peer_time - self.offset
+
+
 class TimeLoop:
     
     def __init__(self, iteration=20):